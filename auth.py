@@ -1,100 +1,210 @@
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Optional
-from jose import JWTError, jwt
+from typing import List, Optional, Tuple
+import jwt
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
-from database import get_db
-from models import User
+from sqlalchemy import select, bindparam
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
+from models import User, Service, UserRole
+from config import settings
+from cachetools import TTLCache
+import redis
+import orjson
+import logging
 import secrets
+import threading
+import time
+
+logger = logging.getLogger(__name__)
 
 # Настройки JWT
 SECRET_KEY = "your-secret-key-change-in-production"  # Замените в продакшене!
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+SECRET_KEY_BYTES = SECRET_KEY.encode()
 
 security = HTTPBearer()
 
 
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    to_encode = data.copy()
+@dataclass(slots=True, frozen=True)
+class CurrentUser:
+    """Аутентифицированный пользователь (порядок полей совпадает с AUTH_USER_COLUMNS)"""
+    id: int
+    phone_number: str
+    role: str
+    is_active: bool
+    created_at: Optional[datetime]
+    # Для роли service: id ее сервиса (выбирается тем же запросом, что и пользователь)
+    service_id: Optional[int] = None
+
+
+# Кэш успешно проверенных токенов: token -> (phone_number, role, exp)
+_token_cache = TTLCache(maxsize=10000, ttl=60)
+_token_cache_lock = threading.Lock()
+
+# Столбцы users, которые читает аутентификация (остальные могут отсутствовать в старых БД)
+AUTH_USER_COLUMNS = (User.id, User.phone_number, User.role, User.is_active, User.created_at)
+
+# Запрос пользователя по телефону собирается один раз при импорте
+_USER_BY_PHONE_STMT = (
+    select(*AUTH_USER_COLUMNS)
+    .where(User.phone_number == bindparam("phone"), User.is_active == True)
+)
+# Для сервисов сразу подтягиваем id их сервиса, чтобы не делать второй запрос в роутерах
+_SERVICE_USER_BY_PHONE_STMT = (
+    select(*AUTH_USER_COLUMNS, Service.id)
+    .outerjoin(Service, Service.user_id == User.id)
+    .where(User.phone_number == bindparam("phone"), User.is_active == True)
+)
+
+# Хранилище SMS-кодов (routers.auth.sms_storage): кэш пользователей использует его пул Redis
+# и его статус Redis. Регистрируется через use_redis_storage, пока не задано - кэш отключен
+_redis_storage = None
+
+
+def use_redis_storage(storage):
+    global _redis_storage
+    _redis_storage = storage
+
+
+def _user_cache_client():
+    """Клиент Redis для кэша пользователей или None, если Redis недоступен (кэш пропускается)"""
+    if _redis_storage is None or not _redis_storage.redis_healthy:
+        return None
+    return _redis_storage.redis_client
+
+
+# Роли из токенов (None - токен без claim role); кэш пользователя хранится отдельно для каждой
+_TOKEN_ROLES = (None, *(role.value for role in UserRole))
+
+
+def _user_cache_key(phone_number: str, role: Optional[str]) -> str:
+    # Роль из токена входит в ключ: после смены роли новый токен не получит данные старой роли.
+    # Регистр не учитывается (в старых токенах роль "CLIENT"), чтобы инвалидация находила все ключи
+    return f"user:{phone_number}:{(role or '').lower()}"
+
+
+async def get_cached_user(phone_number: str, role: Optional[str]) -> Optional[CurrentUser]:
+    """Возвращает пользователя из Redis или None при промахе/недоступности Redis"""
+    redis_client = _user_cache_client()
+    if redis_client is None:
+        return None
+    try:
+        cached = await redis_client.get(_user_cache_key(phone_number, role))
+    except redis.RedisError as e:
+        logger.warning(f"Кэш пользователей недоступен: {e}")
+        return None
+    if cached is None:
+        return None
+    data = orjson.loads(cached)
+    if data["created_at"] is not None:
+        data["created_at"] = datetime.fromisoformat(data["created_at"])
+    return CurrentUser(**data)
+
+
+async def cache_user(user: CurrentUser, role: Optional[str], ttl: int):
+    """Сохраняет данные пользователя (для роли из токена) в Redis на ttl секунд"""
+    redis_client = _user_cache_client()
+    if redis_client is None or ttl <= 0:
+        return
+    try:
+        await redis_client.set(_user_cache_key(user.phone_number, role), orjson.dumps(user), ex=ttl)
+    except redis.RedisError as e:
+        logger.warning(f"Не удалось сохранить пользователя в кэш: {e}")
+
+
+async def invalidate_cached_user(phone_number: str):
+    """Удаляет пользователя из кэша для всех ролей (после блокировки, смены роли или сервиса, выхода)"""
+    redis_client = _user_cache_client()
+    if redis_client is None:
+        return
+    try:
+        await redis_client.delete(*(_user_cache_key(phone_number, role) for role in _TOKEN_ROLES))
+    except redis.RedisError as e:
+        logger.warning(f"Не удалось удалить пользователя из кэша: {e}")
+
+
+def create_access_token(sub: str, expires_delta: Optional[timedelta] = None, **extra):
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    payload = {"sub": sub, "exp": expire}
+    if extra:
+        payload.update(extra)
+    encoded_jwt = jwt.encode(payload, SECRET_KEY_BYTES, algorithm=ALGORITHM)
     return encoded_jwt
 
 
-def verify_token(token: str) -> Optional[str]:
+def decode_token(token: str) -> Optional[Tuple[str, Optional[str], int]]:
     """
-    Проверяет JWT токен и возвращает phone_number если токен валиден
+    Проверяет JWT токен и возвращает (phone_number, role, exp) если токен валиден
     """
+    cached = _token_cache.get(token)
+    if cached is not None:
+        if cached[2] > time.time():
+            return cached
+
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SECRET_KEY_BYTES, algorithms=[ALGORITHM])
         phone_number: str = payload.get("sub")
         if phone_number is None:
             return None
-        return phone_number
-    except JWTError:
+        claims = (phone_number, payload.get("role"), payload["exp"])
+        with _token_cache_lock:
+            _token_cache[token] = claims
+        return claims
+    except jwt.InvalidTokenError:
         return None
 
 
+def verify_token(token: str) -> Optional[str]:
+    """
+    Проверяет JWT токен и возвращает phone_number если токен валиден
+    """
+    claims = decode_token(token)
+    return claims[0] if claims else None
+
+
 async def get_current_active_user(
         credentials: HTTPAuthorizationCredentials = Depends(security),
-        db: Session = Depends(get_db)
-):
-    from sqlalchemy import text
-
+        db: AsyncSession = Depends(get_async_db)
+) -> CurrentUser:
     token = credentials.credentials
-    phone_number = verify_token(token)
-    if phone_number is None:
+    claims = decode_token(token)
+    if claims is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Неверный токен",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    phone_number, role, exp = claims
 
-    # Сначала попробуем получить только базовые поля
-    stmt = text("""
-        SELECT id, phone_number, role, is_active, created_at
-        FROM users 
-        WHERE phone_number = :phone
-    """)
-    result = db.execute(stmt, {"phone": phone_number})
-    user_data = result.fetchone()
+    user = await get_cached_user(phone_number, role)
+    if user is None:
+        # Загружаем только базовые поля (для сервисов - вместе с id сервиса)
+        stmt = _SERVICE_USER_BY_PHONE_STMT if role == UserRole.SERVICE else _USER_BY_PHONE_STMT
+        result = await db.execute(stmt, {"phone": phone_number})
+        user_data = result.first()
 
-    if user_data is None:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Пользователь не найден",
-        )
+        # Неактивные пользователи не выбираются запросом и обрабатываются как неизвестные
+        if user_data is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Неверные учётные данные",
+            )
 
-    # Создаем словарь с данными пользователя
-    user_dict = {
-        "id": user_data[0],
-        "phone_number": user_data[1],
-        "role": user_data[2],
-        "is_active": user_data[3],
-        "created_at": user_data[4],
-        # Добавляем поля по умолчанию для отсутствующих столбцов
-        "first_name": None,
-        "last_name": None,
-        "email": None
-    }
-
-    if not user_dict["is_active"]:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Неактивный пользователь",
-        )
+        user = CurrentUser(*user_data)
+        # Кэшируем на оставшееся время жизни токена
+        await cache_user(user, role, int(exp - time.time()))
 
-    return user_dict
+    return user
 
 def generate_sms_code(length: int = 4) -> str:
     """Генерирует случайный SMS код"""
-    return ''.join([str(secrets.randbelow(10)) for _ in range(length)])
+    return f"{secrets.randbelow(10 ** length):0{length}d}"
 
 
 def send_sms(phone_number: str, code: str) -> bool:
@@ -105,4 +215,10 @@ def send_sms(phone_number: str, code: str) -> bool:
         return True
     except Exception as e:
         print(f"SMS sending failed: {e}")
-        return False
\ No newline at end of file
+        return False
+
+
+def send_sms_bulk(messages: List[Tuple[str, str]]) -> List[bool]:
+    """Пакетная отправка SMS одним запросом к провайдеру (заглушка для разработки)"""
+    # В реальном приложении здесь будет bulk-эндпоинт SMS-сервиса
+    return [send_sms(phone_number, code) for phone_number, code in messages]
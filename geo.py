@@ -0,0 +1,77 @@
+"""Расчет расстояний между координатами (используется для поиска ПВЗ без PostGIS)"""
+import logging
+import math
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0
+# Координаты хранятся и обрабатываются в float32: погрешность расстояния в пределах метра,
+# а массивы вдвое меньше и sin/cos обрабатывают вдвое больше значений за инструкцию
+COORD_DTYPE = np.float32
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+    logger.warning("numba не установлен: расстояния до ПВЗ считаются через numpy")
+
+
+def haversine_km(lats: np.ndarray, lons: np.ndarray, lat0: float, lon0: float) -> np.ndarray:
+    """Расстояния (км) от точки (lat0, lon0) до каждой из точек (lats[i], lons[i]) по формуле гаверсинусов"""
+    lats_rad = np.radians(lats)
+    dlat = lats_rad - np.radians(lat0)
+    dlon = np.radians(lons - lon0)
+    a = np.sin(dlat / 2) ** 2 + np.cos(np.radians(lat0)) * np.cos(lats_rad) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def _haversine_filter(lats, lons, lat0, lon0, radius_km, out_dist, out_idx):
+        """Считает расстояния и сразу отбирает точки в радиусе; возвращает число найденных"""
+        lat0_rad = math.radians(lat0)
+        cos_lat0 = math.cos(lat0_rad)
+        n = 0
+        for i in range(lats.shape[0]):
+            lat_rad = math.radians(lats[i])
+            sin_dlat = math.sin((lat_rad - lat0_rad) / 2)
+            sin_dlon = math.sin(math.radians(lons[i] - lon0) / 2)
+            a = sin_dlat * sin_dlat + cos_lat0 * math.cos(lat_rad) * sin_dlon * sin_dlon
+            d = 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+            if d <= radius_km:
+                out_dist[n] = d
+                out_idx[n] = i
+                n += 1
+        return n
+
+    # Компилируем при импорте, чтобы первый запрос не ждал JIT
+    _zero = COORD_DTYPE(0)
+    _haversine_filter(
+        np.zeros(1, COORD_DTYPE), np.zeros(1, COORD_DTYPE), _zero, _zero, COORD_DTYPE(1),
+        np.empty(1, COORD_DTYPE), np.empty(1, np.int64)
+    )
+else:
+    _haversine_filter = None
+
+
+def within_radius(lats: np.ndarray, lons: np.ndarray, lat0: float, lon0: float, radius_km: float):
+    """Возвращает (индексы, расстояния) точек в радиусе radius_km, по возрастанию расстояния.
+
+    Расчет ведется в точности массивов lats/lons (см. COORD_DTYPE)
+    """
+    # Скаляры приводятся к типу массивов, иначе float64 повысит точность всего расчета
+    dtype = lats.dtype.type
+    lat0, lon0, radius_km = dtype(lat0), dtype(lon0), dtype(radius_km)
+    if _haversine_filter is not None:
+        out_dist = np.empty(lats.shape[0], lats.dtype)
+        out_idx = np.empty(lats.shape[0], np.int64)
+        n = _haversine_filter(lats, lons, lat0, lon0, radius_km, out_dist, out_idx)
+        idx, distances = out_idx[:n], out_dist[:n]
+    else:
+        distances = haversine_km(lats, lons, lat0, lon0)
+        idx = np.flatnonzero(distances <= radius_km)
+        distances = distances[idx]
+    order = np.argsort(distances, kind="stable")
+    return idx[order], distances[order]
@@ -0,0 +1,8 @@
+"""Создание таблиц базы данных (однократно при развертывании): python -m init_db"""
+import models  # noqa: F401 - регистрирует модели в Base.metadata
+from database import create_tables
+
+
+if __name__ == "__main__":
+    create_tables()
+    print("Таблицы созданы")
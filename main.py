@@ -1,39 +1,76 @@
 from fastapi import FastAPI, HTTPException, Depends, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from contextlib import asynccontextmanager
 # from sqlalchemy.orm import Session
 import uvicorn
 from typing import Optional
 import os
-from dotenv import load_dotenv
+import sys
+import asyncio
+import logging
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+
+# Настройка логирования: обработчики пишут в очередь, вывод в stderr идет в отдельном потоке
+log_queue = queue.SimpleQueue()
+logging.getLogger().addHandler(QueueHandler(log_queue))
+logging.getLogger().setLevel(logging.INFO)
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_listener = QueueListener(log_queue, log_stream_handler)
+# Слушатель запускается вместе с установкой обработчика: записи, сделанные при импорте модулей
+# или без запуска приложения, тоже выводятся; при выходе очередь дописывается до конца
+log_listener.start()
+atexit.register(log_listener.stop)
 #
-from database import get_db, engine
-from models import Base
 from routers import auth, orders, users, pvz, services
 from schemas import TokenData
 from auth import verify_token
+from config import settings
+
 
-load_dotenv()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await auth.sms_storage.init_redis()
 
-# Создание таблиц
-Base.metadata.create_all(bind=engine)
+    # Фоновые задачи приложения
+    tasks = [
+        asyncio.create_task(auth.sms_gc_loop()),
+        asyncio.create_task(auth.sms_dispatch_loop()),
+        asyncio.create_task(auth.redis_health_loop()),
+    ]
+    # In-memory индекс ПВЗ нужен только без PostGIS и при установленном rtree
+    if pvz.pvz_index.available and not settings.USE_POSTGIS:
+        tasks.append(asyncio.create_task(pvz.pvz_index_refresh_loop()))
+    yield
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # Пул Redis общий для SMS-кодов и кэша пользователей
+    await auth.sms_storage.close()
 
 
 app = FastAPI(
     title="Repair Service API",
     description="API для сервиса ремонта и чистки",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Настройка CORS
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # В продакшене указать конкретные домены
+    allow_origins=[origin.strip() for origin in settings.CORS_ORIGINS.split(",") if origin.strip()],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
+
 security = HTTPBearer()
 
 # Подключение роутеров
@@ -52,9 +89,13 @@ async def health_check():
     return {"status": "healthy", "version": "1.0.0"}
 
 if __name__ == "__main__":
+    # uvloop (C event loop) и httptools (C парсер HTTP); uvloop не поддерживает Windows
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=8000,
-        reload=True
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=1 if settings.DEV else settings.WEB_CONCURRENCY,
+        reload=settings.DEV
     )
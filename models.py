@@ -1,6 +1,7 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, Float, ForeignKey, Enum as SQLEnum
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, Float, ForeignKey, Index, CheckConstraint, Sequence
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.sql import func, text
 from database import Base
 import enum
 
@@ -43,11 +44,39 @@ class VerificationStatus(str, enum.Enum):
     REJECTED = "rejected"
 
 
+class EnumString(TypeDecorator):
+    """Строковый столбец для str-enum: пишет значение enum, читает обычную строку"""
+    impl = String
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return value.value if isinstance(value, enum.Enum) else value
+
+
+def enum_check(column: str, enum_cls) -> CheckConstraint:
+    """CHECK-ограничение на допустимые значения enum вместо типа ENUM в Postgres"""
+    values = ", ".join(f"'{item.value}'" for item in enum_cls)
+    return CheckConstraint(f"{column} IN ({values})", name=f"ck_{column}_values")
+
+
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        # Покрывающий индекс для аутентификации: поиск по телефону без чтения таблицы
+        Index(
+            "ix_users_phone_covering",
+            "phone_number",
+            unique=True,
+            postgresql_include=["id", "role", "is_active", "created_at"],
+        ),
+        # Список активных пользователей с keyset-пагинацией по id: без фильтра по роли...
+        Index("ix_users_active_id", "id", postgresql_where=text("is_active")),
+        # ...и с фильтром по роли
+        Index("ix_users_active_role_id", "role", "id", postgresql_where=text("is_active")),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    phone_number = Column(String, unique=True, index=True)
+    phone_number = Column(String)
     role = Column(String, nullable=False, default="CLIENT")  # Обновите значение по умолчанию
     first_name = Column(String, nullable=True)
     last_name = Column(String, nullable=True)
@@ -59,12 +88,18 @@ class User(Base):
     # Связи
     orders = relationship("Order", back_populates="user", foreign_keys="Order.user_id")
     service_orders = relationship("Order", back_populates="service", foreign_keys="Order.service_id")
-    reviews = relationship("Review", back_populates="client")
-    received_reviews = relationship("Review", back_populates="service")
+    reviews = relationship("Review", back_populates="client", foreign_keys="Review.client_id")
+    received_reviews = relationship("Review", back_populates="service", foreign_keys="Review.service_id")
 
 
 class Service(Base):
     __tablename__ = "services"
+    __table_args__ = (
+        enum_check("verification_status", VerificationStatus),
+        # Keyset-пагинация списка сервисов по рейтингу
+        # Выражение совпадает с SERVICE_RATING в routers/services.py (NULL-рейтинг сортируется как 0)
+        Index("ix_services_rating_id", text("coalesce(average_rating, 0) DESC"), text("id DESC")),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -74,7 +109,7 @@ class Service(Base):
     description = Column(Text, nullable=True)
     phone = Column(String, nullable=True)
     email = Column(String, nullable=True)
-    verification_status = Column(SQLEnum(VerificationStatus), default=VerificationStatus.PENDING)
+    verification_status = Column(EnumString(16), default=VerificationStatus.PENDING.value)
     bank_account = Column(String, nullable=True)
     bank_bik = Column(String, nullable=True)
     average_rating = Column(Float, default=0.0)
@@ -90,6 +125,10 @@ class Service(Base):
 
 class PVZ(Base):
     __tablename__ = "pvz"
+    __table_args__ = (
+        # Список активных ПВЗ с keyset-пагинацией по id (неактивные строки в индекс не попадают)
+        Index("ix_pvz_active_id", "id", postgresql_where=text("is_active")),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -115,6 +154,10 @@ class PVZ(Base):
 
 class ServiceOffering(Base):
     __tablename__ = "service_offerings"
+    __table_args__ = (
+        # Активные услуги сервиса
+        Index("ix_service_offerings_active_service", "service_id", postgresql_where=text("is_active")),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     service_id = Column(Integer, ForeignKey("services.id"), nullable=False)
@@ -142,27 +185,37 @@ class ServiceArea(Base):
     service = relationship("Service", back_populates="service_areas")
 
 
+# Сквозной номер заказа для order_number (без коллизий, в отличие от случайного суффикса)
+order_number_seq = Sequence("order_number_seq", metadata=Base.metadata)
+
+
 class Order(Base):
     __tablename__ = "orders"
+    __table_args__ = (
+        enum_check("category", OrderCategory),
+        enum_check("payment_method", PaymentMethod),
+        enum_check("status", OrderStatus),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     order_number = Column(String, unique=True, index=True, nullable=False)
     client_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     service_id = Column(Integer, ForeignKey("users.id"), nullable=True)
-    receive_pvz_id = Column(Integer, ForeignKey("pvz.id"), nullable=False)
-    delivery_pvz_id = Column(Integer, ForeignKey("pvz.id"), nullable=False)
+    # Отдельные индексы: фильтр ПВЗ "receive IN (...) OR delivery IN (...)" идет через BitmapOr
+    receive_pvz_id = Column(Integer, ForeignKey("pvz.id"), nullable=False, index=True)
+    delivery_pvz_id = Column(Integer, ForeignKey("pvz.id"), nullable=False, index=True)
 
-    category = Column(SQLEnum(OrderCategory), nullable=False)
+    category = Column(EnumString(16), nullable=False)
     subcategory = Column(String, nullable=False)
     description = Column(Text, nullable=False)
     photos = Column(Text, nullable=True)  # JSON список URL фото
     price_limit = Column(Float, nullable=True)
     proposed_price = Column(Float, nullable=True)
     final_price = Column(Float, nullable=True)
-    payment_method = Column(SQLEnum(PaymentMethod), nullable=False)
+    payment_method = Column(EnumString(16), nullable=False)
 
-    status = Column(SQLEnum(OrderStatus), default=OrderStatus.CREATED)
+    status = Column(EnumString(24), default=OrderStatus.CREATED.value)
     price_justification = Column(Text, nullable=True)
     qr_code = Column(String, nullable=True)
     short_id = Column(String, nullable=True)  # Для маркировки (например, "7X9")
@@ -0,0 +1,45 @@
+"""Keyset-пагинация списков.
+
+Курсор - base64 от ключа сортировки последней строки страницы; следующая страница
+выбирается условием WHERE (ключ) < / > (курсор) по индексу, без OFFSET.
+"""
+import base64
+from typing import Callable, List
+
+import orjson
+from fastapi import HTTPException, status
+
+
+def encode_cursor(key: tuple) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps(list(key))).decode()
+
+
+def decode_cursor(cursor: str, size: int) -> List[float]:
+    """Ключ сортировки из курсора (size чисел); 400 при некорректном курсоре"""
+    try:
+        key = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        key = None
+
+    if not isinstance(key, list) or len(key) != size or not all(
+        isinstance(value, (int, float)) and not isinstance(value, bool) for value in key
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Некорректный курсор"
+        )
+    return key
+
+
+def row_as_dict(row) -> dict:
+    return row._asdict()
+
+
+def keyset_page(rows: list, limit: int, key: Callable, item: Callable = row_as_dict) -> dict:
+    """Страница из строк, выбранных с LIMIT limit + 1 (лишняя строка - признак следующей страницы).
+
+    key(row) - ключ сортировки для курсора, item(row) - элемент ответа
+    """
+    items = [item(row) for row in rows[:limit]]
+    next_cursor = encode_cursor(key(rows[limit - 1])) if len(rows) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
@@ -1,66 +1,230 @@
 from fastapi import APIRouter, HTTPException, Depends, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy import exists, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta, datetime
-import redis
+import redis.asyncio as aioredis
 import json
 from typing import Optional
 import logging
+import asyncio
+import heapq
+import threading
 import time
 
-from database import get_db
+from database import get_async_db
 from models import User
-from schemas import PhoneAuth, SMSCode, Token, UserResponse
+from schemas import PhoneAuth, SMSCode, SendSmsResponse, Token, UserResponse
 from auth import (
     create_access_token,
     verify_token,
     get_current_active_user,
+    invalidate_cached_user,
+    use_redis_storage,
+    CurrentUser,
     generate_sms_code,
-    send_sms,
+    send_sms_bulk,
     ACCESS_TOKEN_EXPIRE_MINUTES
 )
 from config import settings
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 security = HTTPBearer()
 
+# SQL-запросы собираются один раз при импорте
+_STMT_FIND_USER = text("SELECT id, is_active, role FROM users WHERE phone_number = :phone")
+_STMT_INSERT_USER = text("""
+    INSERT INTO users (phone_number, role, is_active) 
+    VALUES (:phone, 'CLIENT', true)
+    RETURNING id
+""")
+
+_ALLOWED_ROLES_QUERIES = [
+    "SELECT unnest(enum_range(NULL::userrole)) as role",
+    "SELECT enumlabel FROM pg_enum WHERE enumtypid = (SELECT oid FROM pg_type WHERE typname = 'userrole')",
+    "SELECT DISTINCT role FROM users WHERE role IS NOT NULL"
+]
+_ALLOWED_ROLES_STMTS = [text(query) for query in _ALLOWED_ROLES_QUERIES]
+_STMT_EXISTING_USERS = text("SELECT id, phone_number, role, is_active FROM users LIMIT 10")
+_STMT_SELECT_1 = text("SELECT 1")
+_STMT_USERS_TABLE_EXISTS = text("""
+    SELECT EXISTS (
+        SELECT FROM information_schema.tables 
+        WHERE table_schema = 'public' 
+        AND table_name = 'users'
+    )
+""")
+_STMT_USERROLE_TYPE_EXISTS = text("""
+    SELECT EXISTS (
+        SELECT FROM pg_type WHERE typname = 'userrole'
+    )
+""")
+_STMT_PG_ENUM_VALUES = text("""
+    SELECT enumlabel 
+    FROM pg_enum 
+    WHERE enumtypid = (SELECT oid FROM pg_type WHERE typname = 'userrole')
+    ORDER BY enumsortorder
+""")
+_STMT_ENUM_RANGE_VALUES = text("SELECT unnest(enum_range(NULL::userrole))")
+_STMT_EXISTING_ROLES = text("SELECT DISTINCT role FROM users WHERE role IS NOT NULL")
+_STMT_USERS_TABLE_STRUCTURE = text("""
+    SELECT 
+        column_name, 
+        data_type, 
+        is_nullable,
+        column_default
+    FROM information_schema.columns 
+    WHERE table_name = 'users' 
+    ORDER BY ordinal_position
+""")
+
 # In-memory хранилище для разработки (если Redis недоступен)
 dev_sms_storage = {}
-dev_storage_cleanup_time = time.time()
+dev_sms_request_counts = {}
+dev_sms_send_locks = {}
+
+# Удаление ключа, только если в нем все еще то же значение (атомарно на стороне Redis)
+_COMPARE_AND_DELETE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
 
 
 class SMSStorage:
     def __init__(self):
+        self.pool = None
         self.redis_client = None
-        self._init_redis()
-
-    def _init_redis(self):
-        """Инициализация подключения к Redis"""
+        # Последний известный статус Redis (обновляется фоновой задачей)
+        self.redis_healthy = False
+        # Не даем нескольким вызовам очистки сканировать хранилище одновременно
+        self._scan_lock = threading.Lock()
+        # Кучи (expires, phone) для очистки без обхода всего хранилища
+        self._exp_heap = []
+        self._counter_heap = []
+        self._lock_heap = []
+
+    async def init_redis(self):
+        """Инициализация пула подключений к Redis (вызывается в lifespan приложения)"""
         try:
-            self.redis_client = redis.Redis(
+            self.pool = aioredis.ConnectionPool(
                 host=settings.REDIS_HOST,
                 port=settings.REDIS_PORT,
                 password=getattr(settings, 'REDIS_PASSWORD', None),
                 decode_responses=True,
                 socket_connect_timeout=5,
                 socket_timeout=5,
-                retry_on_timeout=True
+                retry_on_timeout=True,
+                max_connections=settings.REDIS_POOL_SIZE
             )
-            self.redis_client.ping()
+            self.redis_client = aioredis.Redis(connection_pool=self.pool)
+            await self.redis_client.ping()
+            self.redis_healthy = True
             logger.info("Redis подключен успешно")
         except Exception as e:
             logger.warning(f"Redis не доступен: {e}. Используется in-memory хранилище")
             self.redis_client = None
 
-    def set_sms_code(self, phone_number: str, code: str, ttl: int = 300):
+    async def refresh_health(self):
+        """Обновляет статус Redis одним PING"""
+        try:
+            self.redis_healthy = bool(self.redis_client and await self.redis_client.ping())
+        except Exception:
+            self.redis_healthy = False
+
+    async def close(self):
+        """Закрытие пула подключений к Redis"""
+        if self.pool:
+            await self.pool.disconnect()
+
+    async def issue_otp(self, phone_number: str) -> Optional[str]:
+        """Выдает SMS код с ограничением частоты запросов.
+
+        Повторный запрос до истечения кода возвращает уже выданный код,
+        поэтому параллельные запросы не порождают разные коды.
+        Возвращает None, если превышен лимит запросов для номера.
+        """
+        if self.redis_client:
+            try:
+                counter_key = f"sms_code:req:{phone_number}"
+                requests = await self.redis_client.incr(counter_key)
+                if requests == 1:
+                    await self.redis_client.expire(counter_key, settings.SMS_RATE_WINDOW)
+                if requests > settings.SMS_RATE_LIMIT:
+                    return None
+
+                key = f"sms_code:{phone_number}"
+                code = generate_sms_code()
+                if await self.redis_client.set(key, code, nx=True, ex=settings.SMS_CODE_TTL):
+                    return code
+                existing = await self.redis_client.get(key)
+                if existing is None:
+                    # Код истек между SET NX и GET
+                    await self.redis_client.set(key, code, ex=settings.SMS_CODE_TTL)
+                    return code
+                return existing
+            except Exception as e:
+                logger.error(f"Ошибка выдачи кода в Redis: {e}")
+                self.redis_client = None
+                return self._issue_otp_fallback(phone_number)
+        else:
+            return self._issue_otp_fallback(phone_number)
+
+    async def acquire_send_lock(self, phone_number: str) -> bool:
+        """Блокирует повторную отправку кода на номер на SMS_RESEND_INTERVAL секунд.
+
+        Возвращает False, если отправка на этот номер уже идет или была недавно.
+        """
+        if self.redis_client:
+            try:
+                return bool(await self.redis_client.set(
+                    f"sms_lock:{phone_number}", "1", nx=True, ex=settings.SMS_RESEND_INTERVAL
+                ))
+            except Exception as e:
+                logger.error(f"Ошибка блокировки в Redis: {e}")
+                self.redis_client = None
+                return self._acquire_send_lock_fallback(phone_number)
+        else:
+            return self._acquire_send_lock_fallback(phone_number)
+
+    def _acquire_send_lock_fallback(self, phone_number: str) -> bool:
+        """Fallback блокировки в памяти"""
+        now = time.time()
+        lock = dev_sms_send_locks.get(phone_number)
+        if lock and now < lock['expires']:
+            return False
+        expires = now + settings.SMS_RESEND_INTERVAL
+        dev_sms_send_locks[phone_number] = {'expires': expires}
+        heapq.heappush(self._lock_heap, (expires, phone_number))
+        return True
+
+    def _issue_otp_fallback(self, phone_number: str) -> Optional[str]:
+        """Fallback выдачи кода в памяти"""
+        now = time.time()
+        counter = dev_sms_request_counts.get(phone_number)
+        if not counter or now >= counter['expires']:
+            counter = {'count': 0, 'expires': now + settings.SMS_RATE_WINDOW}
+            dev_sms_request_counts[phone_number] = counter
+            heapq.heappush(self._counter_heap, (counter['expires'], phone_number))
+        counter['count'] += 1
+        if counter['count'] > settings.SMS_RATE_LIMIT:
+            return None
+
+        existing = self._get_sms_code_fallback(phone_number)
+        if existing:
+            return existing
+        code = generate_sms_code()
+        self._set_sms_code_fallback(phone_number, code, settings.SMS_CODE_TTL)
+        return code
+
+    async def set_sms_code(self, phone_number: str, code: str, ttl: int = 300):
         """Сохраняет SMS код"""
         if self.redis_client:
             try:
-                self.redis_client.setex(f"sms_code:{phone_number}", ttl, code)
+                await self.redis_client.setex(f"sms_code:{phone_number}", ttl, code)
                 return True
             except Exception as e:
                 logger.error(f"Ошибка сохранения в Redis: {e}")
@@ -72,21 +236,23 @@ class SMSStorage:
     def _set_sms_code_fallback(self, phone_number: str, code: str, ttl: int):
         """Fallback сохранения в памяти"""
         try:
+            expires = time.time() + ttl
             dev_sms_storage[phone_number] = {
                 'code': code,
-                'expires': time.time() + ttl
+                'expires': expires
             }
+            heapq.heappush(self._exp_heap, (expires, phone_number))
             logger.info(f"Код сохранен в памяти для {phone_number}")
             return True
         except Exception as e:
             logger.error(f"Ошибка сохранения в памяти: {e}")
             return False
 
-    def get_sms_code(self, phone_number: str) -> Optional[str]:
+    async def get_sms_code(self, phone_number: str) -> Optional[str]:
         """Получает SMS код"""
         if self.redis_client:
             try:
-                return self.redis_client.get(f"sms_code:{phone_number}")
+                return await self.redis_client.get(f"sms_code:{phone_number}")
             except Exception as e:
                 logger.error(f"Ошибка чтения из Redis: {e}")
                 self.redis_client = None
@@ -97,13 +263,6 @@ class SMSStorage:
     def _get_sms_code_fallback(self, phone_number: str) -> Optional[str]:
         """Fallback чтения из памяти"""
         try:
-            global dev_storage_cleanup_time
-
-            # Очистка устаревших кодов каждые 5 минут
-            if time.time() - dev_storage_cleanup_time > 300:
-                self._cleanup_expired_codes()
-                dev_storage_cleanup_time = time.time()
-
             data = dev_sms_storage.get(phone_number)
             if data and time.time() < data['expires']:
                 return data['code']
@@ -114,11 +273,31 @@ class SMSStorage:
             logger.error(f"Ошибка чтения из памяти: {e}")
             return None
 
-    def delete_sms_code(self, phone_number: str):
+    async def consume_sms_code(self, phone_number: str) -> Optional[str]:
+        """Получает и сразу удаляет SMS код (код можно использовать только один раз)"""
+        if self.redis_client:
+            try:
+                # GETDEL (Redis >= 6.2): атомарное чтение и удаление одной командой
+                return await self.redis_client.getdel(f"sms_code:{phone_number}")
+            except Exception as e:
+                logger.error(f"Ошибка чтения из Redis: {e}")
+                self.redis_client = None
+                return self._consume_sms_code_fallback(phone_number)
+        else:
+            return self._consume_sms_code_fallback(phone_number)
+
+    def _consume_sms_code_fallback(self, phone_number: str) -> Optional[str]:
+        """Fallback получения и удаления из памяти"""
+        data = dev_sms_storage.pop(phone_number, None)
+        if data and time.time() < data['expires']:
+            return data['code']
+        return None
+
+    async def delete_sms_code(self, phone_number: str):
         """Удаляет SMS код"""
         if self.redis_client:
             try:
-                self.redis_client.delete(f"sms_code:{phone_number}")
+                await self.redis_client.delete(f"sms_code:{phone_number}")
             except Exception as e:
                 logger.error(f"Ошибка удаления из Redis: {e}")
                 self.redis_client = None
@@ -134,66 +313,142 @@ class SMSStorage:
         except Exception as e:
             logger.error(f"Ошибка удаления из памяти: {e}")
 
+    async def discard_sms_code(self, phone_number: str, code: str):
+        """Удаляет SMS код, только если сохранен именно этот код (не удаляет выданный позже)"""
+        if self.redis_client:
+            try:
+                await self.redis_client.eval(_COMPARE_AND_DELETE_LUA, 1, f"sms_code:{phone_number}", code)
+            except Exception as e:
+                logger.error(f"Ошибка удаления из Redis: {e}")
+                self.redis_client = None
+                self._discard_sms_code_fallback(phone_number, code)
+        else:
+            self._discard_sms_code_fallback(phone_number, code)
+
+    def _discard_sms_code_fallback(self, phone_number: str, code: str):
+        """Fallback удаления из памяти при совпадении кода"""
+        data = dev_sms_storage.get(phone_number)
+        if data and data['code'] == code:
+            del dev_sms_storage[phone_number]
+
+    @staticmethod
+    def _evict_expired(heap: list, storage: dict, current_time: float) -> int:
+        """Удаляет из storage записи, истекшие к current_time, снимая их с вершины кучи.
+
+        Записи кучи, которые уже удалены или перезаписаны с новым сроком, пропускаются.
+        """
+        removed = 0
+        while heap and heap[0][0] <= current_time:
+            expires, phone = heapq.heappop(heap)
+            data = storage.get(phone)
+            if data and data['expires'] == expires:
+                del storage[phone]
+                removed += 1
+        return removed
+
     def _cleanup_expired_codes(self):
-        """Очистка устаревших кодов"""
+        """Очистка устаревших кодов (пропускается, если очистка уже идет)"""
+        if not self._scan_lock.acquire(blocking=False):
+            return
         try:
             current_time = time.time()
-            expired_phones = [
-                phone for phone, data in dev_sms_storage.items()
-                if current_time >= data['expires']
-            ]
-            for phone in expired_phones:
-                del dev_sms_storage[phone]
-            if expired_phones:
-                logger.info(f"Очищено {len(expired_phones)} устаревших кодов")
+            removed = self._evict_expired(self._exp_heap, dev_sms_storage, current_time)
+            self._evict_expired(self._counter_heap, dev_sms_request_counts, current_time)
+            self._evict_expired(self._lock_heap, dev_sms_send_locks, current_time)
+            if removed:
+                logger.info(f"Очищено {removed} устаревших кодов")
         except Exception as e:
             logger.error(f"Ошибка очистки кодов: {e}")
+        finally:
+            self._scan_lock.release()
 
 
 # Инициализация хранилища
 sms_storage = SMSStorage()
+# Кэш пользователей при аутентификации работает через тот же пул Redis
+use_redis_storage(sms_storage)
+
 
+# Очередь SMS на отправку: (номер, код)
+sms_queue: asyncio.Queue = asyncio.Queue()
 
-@router.post("/send-sms", response_model=dict)
-async def send_sms_code(phone_auth: PhoneAuth, db: Session = Depends(get_db)):
+
+async def sms_dispatch_loop():
+    """Фоновая пакетная отправка SMS из очереди (запускается в lifespan приложения)"""
+    while True:
+        batch = [await sms_queue.get()]
+        # Даем очереди накопиться и забираем не больше пакета
+        await asyncio.sleep(settings.SMS_BATCH_INTERVAL)
+        while len(batch) < settings.SMS_BATCH_SIZE and not sms_queue.empty():
+            batch.append(sms_queue.get_nowait())
+
+        logger.info(f"Отправка пакета из {len(batch)} SMS")
+        try:
+            results = await asyncio.to_thread(send_sms_bulk, batch)
+        except Exception as e:
+            logger.error(f"Исключение при отправке SMS: {e}")
+            results = [False] * len(batch)
+
+        for (phone_number, code), sent in zip(batch, results):
+            if not sent:
+                logger.error(f"Ошибка отправки SMS на {phone_number}")
+                # Удаляем код если SMS не отправлено (если пользователь уже запросил новый код - не трогаем его)
+                await sms_storage.discard_sms_code(phone_number, code)
+
+        # Не превышаем лимит провайдера: следующий пакет не раньше, чем через len(batch) / rate секунд
+        await asyncio.sleep(len(batch) / settings.SMS_PROVIDER_RATE)
+
+
+async def redis_health_loop():
+    """Фоновая проверка Redis, чтобы /health не выполнял PING на каждый запрос"""
+    while True:
+        await asyncio.sleep(settings.REDIS_HEALTH_INTERVAL)
+        await sms_storage.refresh_health()
+
+
+async def sms_gc_loop():
+    """Фоновая очистка устаревших кодов (запускается в lifespan приложения)"""
+    while True:
+        await asyncio.sleep(settings.SMS_GC_INTERVAL)
+        sms_storage._cleanup_expired_codes()
+
+
+@router.post(
+    "/send-sms",
+    response_model=SendSmsResponse,
+    response_model_exclude_none=True,
+    status_code=status.HTTP_202_ACCEPTED
+)
+async def send_sms_code(phone_auth: PhoneAuth, db: AsyncSession = Depends(get_async_db)):
     """Отправка SMS кода для аутентификации"""
     try:
         logger.info(f"Получен запрос на отправку SMS для: {phone_auth.phone_number}")
 
-        # Генерируем код
-        code = generate_sms_code()
-        logger.info(f"Сгенерирован код: {code} для номера: {phone_auth.phone_number}")
-
-        # Сохраняем код
-        if not sms_storage.set_sms_code(phone_auth.phone_number, code):
+        # Повторное нажатие "отправить код" не должно порождать вторую отправку
+        if not await sms_storage.acquire_send_lock(phone_auth.phone_number):
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Ошибка сохранения кода"
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Код уже отправлен, подождите"
             )
 
-        # Отправляем SMS
-        logger.info(f"Попытка отправки SMS на {phone_auth.phone_number}")
-        try:
-            sms_result = send_sms(phone_auth.phone_number, code)
-        except Exception as e:
-            logger.error(f"Исключение при отправке SMS: {e}")
-            sms_result = False
-
-        if sms_result:
-            logger.info(f"SMS успешно отправлено на {phone_auth.phone_number}")
-            return {
-                "message": "SMS код отправлен",
-                "phone_number": phone_auth.phone_number,
-                "code": code  # Только для разработки!
-            }
-        else:
-            logger.error(f"Ошибка отправки SMS на {phone_auth.phone_number}")
-            # Удаляем код если SMS не отправлено
-            sms_storage.delete_sms_code(phone_auth.phone_number)
+        # Получаем код (новый или уже выданный) с учетом лимита запросов
+        code = await sms_storage.issue_otp(phone_auth.phone_number)
+        if code is None:
+            logger.warning(f"Превышен лимит запросов кода для: {phone_auth.phone_number}")
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Ошибка отправки SMS"
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Слишком много запросов кода. Попробуйте позже."
             )
+        logger.debug("Выдан код: %s для номера: %s", code, phone_auth.phone_number)
+
+        # Ставим SMS в очередь пакетной отправки, не дожидаясь SMS-провайдера
+        await sms_queue.put((phone_auth.phone_number, code))
+
+        return SendSmsResponse(
+            message="SMS код отправлен",
+            phone_number=phone_auth.phone_number,
+            code=code if settings.DEV else None  # Код в ответе только для разработки!
+        )
 
     except HTTPException:
         raise
@@ -206,14 +461,14 @@ async def send_sms_code(phone_auth: PhoneAuth, db: Session = Depends(get_db)):
 
 
 @router.post("/verify", response_model=Token)
-async def verify_sms_code(sms_code: SMSCode, db: Session = Depends(get_db)):
+async def verify_sms_code(sms_code: SMSCode, db: AsyncSession = Depends(get_async_db)):
     """Проверка SMS кода и выдача токена"""
     try:
         logger.info(f"Попытка верификации кода для: {sms_code.phone_number}")
 
-        # Получаем код из хранилища
-        stored_code = sms_storage.get_sms_code(sms_code.phone_number)
-        logger.info(f"Получен код: {stored_code} для номера: {sms_code.phone_number}")
+        # Получаем код из хранилища и сразу удаляем его
+        stored_code = await sms_storage.consume_sms_code(sms_code.phone_number)
+        logger.debug("Получен код: %s для номера: %s", stored_code, sms_code.phone_number)
 
         if not stored_code:
             logger.warning(f"Код не найден для номера: {sms_code.phone_number}")
@@ -222,9 +477,6 @@ async def verify_sms_code(sms_code: SMSCode, db: Session = Depends(get_db)):
                 detail="Код не найден или истек. Запросите новый код."
             )
 
-        # Удаляем код перед проверкой
-        sms_storage.delete_sms_code(sms_code.phone_number)
-
         if stored_code != sms_code.code:
             logger.warning(
                 f"Неверный код для {sms_code.phone_number}. Ожидался: {stored_code}, получен: {sms_code.code}")
@@ -236,18 +488,17 @@ async def verify_sms_code(sms_code: SMSCode, db: Session = Depends(get_db)):
         logger.info(f"Код верный для {sms_code.phone_number}")
 
         # Полностью обходим ORM используя сырые SQL запросы
-        from sqlalchemy import text
-
         # Проверяем существование пользователя
-        check_stmt = text("SELECT id, is_active FROM users WHERE phone_number = :phone")
-        result = db.execute(check_stmt, {"phone": sms_code.phone_number})
+        result = await db.execute(_STMT_FIND_USER, {"phone": sms_code.phone_number})
         user_data = result.fetchone()
 
         user_id = None
+        role = "CLIENT"
 
         if user_data:
             user_id = user_data[0]
             is_active = user_data[1]
+            role = user_data[2]
 
             if not is_active:
                 logger.warning(f"Попытка входа заблокированного пользователя: {sms_code.phone_number}")
@@ -261,19 +512,14 @@ async def verify_sms_code(sms_code: SMSCode, db: Session = Depends(get_db)):
 
             try:
                 # Создаем пользователя с ролью CLIENT
-                insert_stmt = text("""
-                    INSERT INTO users (phone_number, role, is_active) 
-                    VALUES (:phone, 'CLIENT', true)
-                    RETURNING id
-                """)
-                result = db.execute(insert_stmt, {"phone": sms_code.phone_number})
+                result = await db.execute(_STMT_INSERT_USER, {"phone": sms_code.phone_number})
                 user_id = result.scalar()
-                db.commit()
+                await db.commit()
                 logger.info(f"Создан пользователь с ID: {user_id} и ролью: CLIENT")
 
             except Exception as create_error:
                 logger.error(f"Ошибка при создании пользователя: {create_error}")
-                db.rollback()
+                await db.rollback()
                 raise HTTPException(
                     status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                     detail="Не удалось создать пользователя в базе данных"
@@ -282,8 +528,9 @@ async def verify_sms_code(sms_code: SMSCode, db: Session = Depends(get_db)):
         # Создаем токен
         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = create_access_token(
-            data={"sub": sms_code.phone_number},
-            expires_delta=access_token_expires
+            sms_code.phone_number,
+            expires_delta=access_token_expires,
+            role=role
         )
 
         logger.info(f"Успешная аутентификация для: {sms_code.phone_number}")
@@ -293,7 +540,7 @@ async def verify_sms_code(sms_code: SMSCode, db: Session = Depends(get_db)):
         raise
     except Exception as e:
         logger.error(f"Неожиданная ошибка при верификации: {str(e)}")
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Ошибка при проверке кода"
@@ -302,7 +549,7 @@ async def verify_sms_code(sms_code: SMSCode, db: Session = Depends(get_db)):
 @router.get("/health")
 async def health_check():
     """Проверка состояния сервиса"""
-    redis_status = "connected" if sms_storage.redis_client and sms_storage.redis_client.ping() else "disconnected"
+    redis_status = "connected" if sms_storage.redis_healthy else "disconnected"
     storage_type = "redis" if redis_status == "connected" else "memory"
 
     return {
@@ -316,45 +563,50 @@ async def health_check():
 
 # Остальные эндпоинты остаются без изменений
 @router.get("/me", response_model=UserResponse)
-async def get_current_user_info(current_user: dict = Depends(get_current_active_user)):
+async def get_current_user_info(current_user: CurrentUser = Depends(get_current_active_user)):
     """Получение информации о текущем пользователе"""
     return current_user
 
 
 @router.post("/logout")
-async def logout(current_user: User = Depends(get_current_active_user)):
+async def logout(current_user: CurrentUser = Depends(get_current_active_user)):
     """Выход из системы"""
+    await invalidate_cached_user(current_user.phone_number)
     return {"message": "Успешный выход из системы"}
 
 
 @router.get("/check-phone/{phone_number}")
-async def check_phone_exists(phone_number: str, db: Session = Depends(get_db)):
+async def check_phone_exists(phone_number: str, db: AsyncSession = Depends(get_async_db)):
     """Проверка существования номера телефона"""
-    user = db.query(User).filter(User.phone_number == phone_number).first()
-    return {"exists": user is not None}
+    phone_exists = await db.scalar(select(exists().where(User.phone_number == phone_number)))
+    return {"exists": bool(phone_exists)}
+
+
+# Значения ENUM меняются только миграциями: debug-эндпоинты читают их из БД один раз
+_enum_values_cache = {}
+
+
+async def _fetch_column(db: AsyncSession, stmt) -> list:
+    """Первая колонка результата. Запрос выполняется в SAVEPOINT: ошибка одного запроса
+    (например, типа userrole нет в схеме) не прерывает транзакцию для следующих"""
+    async with db.begin_nested():
+        result = await db.execute(stmt)
+        return [row[0] for row in result.fetchall()]
 
 
 @router.get("/debug/allowed-roles")
-async def get_allowed_roles(db: Session = Depends(get_db)):
+async def get_allowed_roles(db: AsyncSession = Depends(get_async_db)):
     """Получить допустимые значения ролей из базы данных"""
-    from sqlalchemy import text
+    if "allowed-roles" in _enum_values_cache:
+        return _enum_values_cache["allowed-roles"]
     try:
         # Попробуем несколько способов получить значения ENUM
-        queries = [
-            "SELECT unnest(enum_range(NULL::userrole)) as role",
-            "SELECT enumlabel FROM pg_enum WHERE enumtypid = (SELECT oid FROM pg_type WHERE typname = 'userrole')",
-            "SELECT DISTINCT role FROM users WHERE role IS NOT NULL"
-        ]
-
         results = {}
-        for i, query in enumerate(queries):
+        for i, (query, stmt) in enumerate(zip(_ALLOWED_ROLES_QUERIES, _ALLOWED_ROLES_STMTS)):
             try:
-                stmt = text(query)
-                result = db.execute(stmt)
-                roles = [row[0] for row in result.fetchall()]
                 results[f"query_{i}"] = {
                     "query": query,
-                    "roles": roles
+                    "roles": await _fetch_column(db, stmt)
                 }
             except Exception as e:
                 results[f"query_{i}"] = {
@@ -362,17 +614,17 @@ async def get_allowed_roles(db: Session = Depends(get_db)):
                     "error": str(e)
                 }
 
+        # Кэшируем итог вместе с ошибками: схема не меняется, повтор запросов дал бы тот же результат
+        _enum_values_cache["allowed-roles"] = results
         return results
     except Exception as e:
         return {"error": str(e)}
 
 @router.get("/debug/existing-users")
-async def get_existing_users(db: Session = Depends(get_db)):
+async def get_existing_users(db: AsyncSession = Depends(get_async_db)):
     """Посмотреть существующих пользователей и их роли"""
-    from sqlalchemy import text
     try:
-        stmt = text("SELECT id, phone_number, role, is_active FROM users LIMIT 10")
-        result = db.execute(stmt)
+        result = await db.execute(_STMT_EXISTING_USERS)
         users = []
         for row in result.fetchall():
             users.append({
@@ -387,29 +639,18 @@ async def get_existing_users(db: Session = Depends(get_db)):
 
 
 @router.get("/debug/db-check")
-async def debug_db_check(db: Session = Depends(get_db)):
+async def debug_db_check(db: AsyncSession = Depends(get_async_db)):
     """Проверка подключения к базе данных и структуры таблиц"""
-    from sqlalchemy import text
     try:
         # Проверяем подключение
-        db.execute(text("SELECT 1"))
+        await db.execute(_STMT_SELECT_1)
 
         # Проверяем существование таблицы users
-        result = db.execute(text("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_schema = 'public' 
-                AND table_name = 'users'
-            )
-        """))
+        result = await db.execute(_STMT_USERS_TABLE_EXISTS)
         users_table_exists = result.scalar()
 
         # Проверяем существование типа userrole
-        result = db.execute(text("""
-            SELECT EXISTS (
-                SELECT FROM pg_type WHERE typname = 'userrole'
-            )
-        """))
+        result = await db.execute(_STMT_USERROLE_TYPE_EXISTS)
         userrole_type_exists = result.scalar()
 
         return {
@@ -422,54 +663,32 @@ async def debug_db_check(db: Session = Depends(get_db)):
 
 
 @router.get("/debug/enum-values")
-async def get_enum_values(db: Session = Depends(get_db)):
+async def get_enum_values(db: AsyncSession = Depends(get_async_db)):
     """Получить точные значения ENUM типа userrole"""
-    from sqlalchemy import text
-    try:
-        # Способ 1: через pg_enum (самый надежный)
-        stmt1 = text("""
-            SELECT enumlabel 
-            FROM pg_enum 
-            WHERE enumtypid = (SELECT oid FROM pg_type WHERE typname = 'userrole')
-            ORDER BY enumsortorder
-        """)
-        result1 = db.execute(stmt1)
-        enum_values_1 = [row[0] for row in result1.fetchall()]
-
-        # Способ 2: через enum_range
-        stmt2 = text("SELECT unnest(enum_range(NULL::userrole))")
-        result2 = db.execute(stmt2)
-        enum_values_2 = [row[0] for row in result2.fetchall()]
-
-        # Способ 3: посмотреть существующие роли в таблице users
-        stmt3 = text("SELECT DISTINCT role FROM users WHERE role IS NOT NULL")
-        result3 = db.execute(stmt3)
-        existing_roles = [row[0] for row in result3.fetchall()]
+    if "enum-values" in _enum_values_cache:
+        return _enum_values_cache["enum-values"]
+    # Способ 1: через pg_enum (самый надежный), способ 2: через enum_range,
+    # способ 3: посмотреть существующие роли в таблице users
+    results = {}
+    for key, stmt in (
+            ("from_pg_enum", _STMT_PG_ENUM_VALUES),
+            ("from_enum_range", _STMT_ENUM_RANGE_VALUES),
+            ("existing_roles_in_table", _STMT_EXISTING_ROLES),
+    ):
+        try:
+            results[key] = await _fetch_column(db, stmt)
+        except Exception as e:
+            results[key] = {"error": str(e)}
 
-        return {
-            "from_pg_enum": enum_values_1,
-            "from_enum_range": enum_values_2,
-            "existing_roles_in_table": existing_roles
-        }
-    except Exception as e:
-        return {"error": str(e)}
+    # Кэшируем итог вместе с ошибками (см. get_allowed_roles)
+    _enum_values_cache["enum-values"] = results
+    return results
 
 @router.get("/debug/table-structure")
-async def get_table_structure(db: Session = Depends(get_db)):
+async def get_table_structure(db: AsyncSession = Depends(get_async_db)):
     """Получить структуру таблицы users"""
-    from sqlalchemy import text
     try:
-        stmt = text("""
-            SELECT 
-                column_name, 
-                data_type, 
-                is_nullable,
-                column_default
-            FROM information_schema.columns 
-            WHERE table_name = 'users' 
-            ORDER BY ordinal_position
-        """)
-        result = db.execute(stmt)
+        result = await db.execute(_STMT_USERS_TABLE_STRUCTURE)
         columns = []
         for row in result.fetchall():
             columns.append({
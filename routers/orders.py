@@ -1,24 +1,36 @@
 from fastapi import APIRouter, HTTPException, Depends, status, UploadFile, File
-from sqlalchemy.orm import Session
+from sqlalchemy import exists, false, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, selectinload
 from typing import List, Optional
 import uuid
 import os
+import aiofiles
 from datetime import datetime
 
-from database import get_db
-from models import Order, User, PVZ, OrderPhoto, OrderStatus
+from database import get_async_db
+from models import Order, PVZ, OrderPhoto, OrderStatus, order_number_seq
 from schemas import OrderCreate, OrderUpdate, OrderResponse, OrderWithPhotos
-from auth import get_current_active_user
+from auth import get_current_active_user, CurrentUser
 from config import settings
 
 router = APIRouter()
 
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Поля заказа, которые читает OrderWithPhotos (кроме photos - их берем из order_photos)
+ORDER_FIELDS = tuple(OrderResponse.model_fields)
+# Связанные объекты, которые сериализует OrderResponse; загружаются заранее:
+# AsyncSession не выполняет ленивую загрузку при сериализации
+ORDER_RELATIONS = (Order.client, Order.service, Order.receive_pvz, Order.delivery_pvz)
+# Связанные пользователи и ПВЗ догружаются одним SELECT ... IN на каждую связь
+LOAD_ORDER_RELATIONS = tuple(selectinload(relation) for relation in ORDER_RELATIONS)
+
 
 @router.post("/", response_model=OrderResponse)
 async def create_order(
         order_data: OrderCreate,
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Создание нового заказа"""
     try:
@@ -29,43 +41,40 @@ async def create_order(
                 detail="Только клиенты могут создавать заказы"
             )
 
-        # Проверяем существование ПВЗ
-        receive_pvz = db.query(PVZ).filter(PVZ.id == order_data.receive_pvz_id).first()
-        delivery_pvz = db.query(PVZ).filter(PVZ.id == order_data.delivery_pvz_id).first()
+        # Проверяем существование ПВЗ (обоих одним запросом)
+        needed_pvz_ids = {order_data.receive_pvz_id, order_data.delivery_pvz_id}
+        found_pvz_ids = set(await db.scalars(select(PVZ.id).where(PVZ.id.in_(needed_pvz_ids))))
 
-        if not receive_pvz or not delivery_pvz:
+        if found_pvz_ids != needed_pvz_ids:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="ПВЗ не найден"
             )
 
         # Генерируем номер заказа
-        order_number = f"ORD-{datetime.now().strftime('%Y%m%d')}-{uuid.uuid4().hex[:8].upper()}"
-
-        # Создаем заказ
-        order = Order(
-            order_number=order_number,
-            client_id=current_user.id,
-            receive_pvz_id=order_data.receive_pvz_id,
-            delivery_pvz_id=order_data.delivery_pvz_id,
-            category=order_data.category,
-            subcategory=order_data.subcategory,
-            description=order_data.description,
-            price_limit=order_data.price_limit,
-            payment_method=order_data.payment_method,
-            status=OrderStatus.CREATED
+        order_seq = await db.scalar(order_number_seq.next_value())
+        order_number = f"ORD-{datetime.now().strftime('%Y%m%d')}-{order_seq:08d}"
+
+        # Создаем заказ; строка возвращается через RETURNING вместе со связанными объектами ответа
+        order = await db.scalar(
+            insert(Order)
+            .values(
+                **order_data.model_dump(),
+                order_number=order_number,
+                client_id=current_user.id,
+                status=OrderStatus.CREATED
+            )
+            .returning(Order)
+            .options(*LOAD_ORDER_RELATIONS)
         )
-
-        db.add(order)
-        db.commit()
-        db.refresh(order)
+        await db.commit()
 
         return order
 
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Ошибка при создании заказа: {str(e)}"
@@ -75,44 +84,46 @@ async def create_order(
 @router.get("/", response_model=List[OrderResponse])
 async def get_orders(
         status_filter: Optional[OrderStatus] = None,
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Получение списка заказов"""
-    query = db.query(Order)
+    stmt = select(Order).options(*LOAD_ORDER_RELATIONS)
 
     # Фильтрация по роли пользователя
     if current_user.role == "client":
-        query = query.filter(Order.client_id == current_user.id)
+        stmt = stmt.where(Order.client_id == current_user.id)
     elif current_user.role == "service":
-        query = query.filter(Order.service_id == current_user.id)
+        stmt = stmt.where(Order.service_id == current_user.id)
     elif current_user.role == "pvz":
         # ПВЗ видит заказы, которые они принимают или доставляют
-        query = query.filter(
-            (Order.receive_pvz_id.in_(
-                db.query(PVZ.id).filter(PVZ.user_id == current_user.id)
-            )) |
-            (Order.delivery_pvz_id.in_(
-                db.query(PVZ.id).filter(PVZ.user_id == current_user.id)
-            ))
+        pvz_ids = (await db.scalars(select(PVZ.id).where(PVZ.user_id == current_user.id))).all()
+        stmt = stmt.where(
+            Order.receive_pvz_id.in_(pvz_ids) | Order.delivery_pvz_id.in_(pvz_ids)
         )
 
     # Фильтрация по статусу
     if status_filter:
-        query = query.filter(Order.status == status_filter)
+        stmt = stmt.where(Order.status == status_filter)
 
-    orders = query.order_by(Order.created_at.desc()).all()
+    orders = (await db.scalars(stmt.order_by(Order.created_at.desc()))).all()
     return orders
 
 
 @router.get("/{order_id}", response_model=OrderWithPhotos)
 async def get_order(
         order_id: int,
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Получение заказа по ID"""
-    order = db.query(Order).filter(Order.id == order_id).first()
+    # Фото, пользователи и ПВЗ заказа загружаются тем же запросом
+    result = await db.execute(
+        select(Order)
+        .options(joinedload(Order.order_photos), *(joinedload(relation) for relation in ORDER_RELATIONS))
+        .where(Order.id == order_id)
+    )
+    order = result.unique().scalar_one_or_none()
 
     if not order:
         raise HTTPException(
@@ -127,9 +138,11 @@ async def get_order(
     elif current_user.role == "service" and order.service_id == current_user.id:
         has_access = True
     elif current_user.role == "pvz":
-        pvz_ids = db.query(PVZ.id).filter(PVZ.user_id == current_user.id).all()
-        if order.receive_pvz_id in [p[0] for p in pvz_ids] or order.delivery_pvz_id in [p[0] for p in pvz_ids]:
-            has_access = True
+        # Достаточно проверить, что один из двух ПВЗ заказа принадлежит пользователю
+        has_access = await db.scalar(select(exists().where(
+            PVZ.user_id == current_user.id,
+            PVZ.id.in_((order.receive_pvz_id, order.delivery_pvz_id))
+        )))
 
     if not has_access:
         raise HTTPException(
@@ -137,55 +150,47 @@ async def get_order(
             detail="Нет доступа к этому заказу"
         )
 
-    # Получаем фото заказа
-    photos = db.query(OrderPhoto).filter(OrderPhoto.order_id == order_id).all()
-    photo_urls = [photo.photo_url for photo in photos]
-
-    order_dict = order.__dict__.copy()
-    order_dict['photos'] = photo_urls
+    # Ответ проверяется один раз самим FastAPI по response_model
+    order_data = {field: getattr(order, field) for field in ORDER_FIELDS}
+    order_data['photos'] = [photo.photo_url for photo in order.order_photos]
 
-    return order_dict
+    return order_data
 
 
 @router.put("/{order_id}", response_model=OrderResponse)
 async def update_order(
         order_id: int,
         order_update: OrderUpdate,
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Обновление заказа"""
-    order = db.query(Order).filter(Order.id == order_id).first()
-
-    if not order:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Заказ не найден"
-        )
-
-    # Проверяем права на обновление
-    can_update = False
-    if current_user.role == "client" and order.client_id == current_user.id:
+    # Права на обновление проверяются в самом UPDATE, обновленная строка возвращается через RETURNING
+    stmt = update(Order).where(Order.id == order_id)
+    if current_user.role == "client":
         # Клиент может обновлять только определенные поля
-        can_update = True
-    elif current_user.role == "service" and order.service_id == current_user.id:
-        can_update = True
-    elif current_user.role == "admin":
-        can_update = True
+        stmt = stmt.where(Order.client_id == current_user.id)
+    elif current_user.role == "service":
+        stmt = stmt.where(Order.service_id == current_user.id)
+    elif current_user.role != "admin":
+        stmt = stmt.where(false())
+
+    update_data = order_update.model_dump(exclude_unset=True)
+    order = await db.scalar(stmt.values(**update_data).returning(Order).options(*LOAD_ORDER_RELATIONS))
 
-    if not can_update:
+    if not order:
+        # Ничего не обновлено: заказа нет или нет прав
+        if not await db.scalar(select(exists().where(Order.id == order_id))):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Заказ не найден"
+            )
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Нет прав на обновление заказа"
         )
 
-    # Обновляем поля
-    update_data = order_update.dict(exclude_unset=True)
-    for field, value in update_data.items():
-        setattr(order, field, value)
-
-    db.commit()
-    db.refresh(order)
+    await db.commit()
 
     return order
 
@@ -194,11 +199,11 @@ async def update_order(
 async def upload_order_photos(
         order_id: int,
         files: List[UploadFile] = File(...),
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Загрузка фотографий для заказа"""
-    order = db.query(Order).filter(Order.id == order_id).first()
+    order = await db.get(Order, order_id)
 
     if not order:
         raise HTTPException(
@@ -218,35 +223,51 @@ async def upload_order_photos(
     os.makedirs(upload_dir, exist_ok=True)
 
     uploaded_files = []
+    # Файлы, записанные в этом запросе: при ошибке удаляются все, чтобы не оставлять файлы без записей в БД
+    written_paths = []
 
-    for file in files:
-        # Проверяем размер файла
-        if file.size > settings.MAX_FILE_SIZE:
-            raise HTTPException(
-                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-                detail=f"Файл {file.filename} слишком большой"
+    try:
+        for file in files:
+            # Генерируем уникальное имя файла
+            file_extension = os.path.splitext(file.filename)[1]
+            filename = f"{uuid.uuid4()}{file_extension}"
+            file_path = os.path.join(upload_dir, filename)
+
+            # Сохраняем файл по частям, проверяя размер по ходу записи (file.size может быть неизвестен)
+            written = 0
+            written_paths.append(file_path)
+            async with aiofiles.open(file_path, "wb") as buffer:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    written += len(chunk)
+                    if written > settings.MAX_FILE_SIZE:
+                        break
+                    await buffer.write(chunk)
+
+            if written > settings.MAX_FILE_SIZE:
+                raise HTTPException(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    detail=f"Файл {file.filename} слишком большой"
+                )
+
+            uploaded_files.append(f"/uploads/order_{order_id}/{filename}")
+
+        # Сохраняем информацию о файлах в базе одним INSERT
+        if uploaded_files:
+            await db.execute(
+                insert(OrderPhoto),
+                [
+                    {"order_id": order_id, "photo_type": "initial", "photo_url": photo_url}
+                    for photo_url in uploaded_files
+                ]
             )
-
-        # Генерируем уникальное имя файла
-        file_extension = os.path.splitext(file.filename)[1]
-        filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = os.path.join(upload_dir, filename)
-
-        # Сохраняем файл
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
-
-        # Сохраняем информацию о файле в базе
-        photo_url = f"/uploads/order_{order_id}/{filename}"
-        order_photo = OrderPhoto(
-            order_id=order_id,
-            photo_type="initial",
-            photo_url=photo_url
-        )
-        db.add(order_photo)
-        uploaded_files.append(photo_url)
-
-    db.commit()
+        await db.commit()
+    except BaseException:
+        # В том числе при отмене запроса (разрыв соединения клиентом)
+        for path in written_paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        raise
 
     return {"message": "Фотографии загружены", "files": uploaded_files}
\ No newline at end of file
@@ -1,21 +1,183 @@
-from fastapi import APIRouter, HTTPException, Depends, status
-from sqlalchemy.orm import Session
-from typing import List, Optional
-from geopy.distance import geodesic
-
-from database import get_db
-from models import PVZ, User
-from schemas import PVZCreate, PVZResponse
-from auth import get_current_active_user
+from fastapi import APIRouter, HTTPException, Depends, Query, status
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import Select, event, exists, func, insert, literal_column, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, object_session
+from typing import Optional
+import numpy as np
+import asyncio
+import logging
+import math
+import threading
+
+from database import get_async_db, engine, insert_unless_exists, lock_owner
+from models import PVZ
+from schemas import Page, PVZCreate, PVZResponse, PVZResponseWithDistance
+from auth import get_current_active_user, CurrentUser
+from config import settings
+from geo import COORD_DTYPE, within_radius
+from pagination import decode_cursor, keyset_page
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# Колонка geog создается init_db при USE_POSTGIS (в модели ее нет: тип geography требует PostGIS)
+PVZ_GEOG = literal_column("pvz.geog")
+
+# Колонки ответа ПВЗ: списки ПВЗ выбираются строками, без создания объектов модели
+PVZ_RESPONSE_COLUMNS = tuple(getattr(PVZ, field) for field in PVZResponse.model_fields)
+# Размер пачки при потоковом чтении ПВЗ для расчета расстояний без PostGIS и индекса
+PVZ_STREAM_BATCH_SIZE = 1024
+
+
+class PVZIndex:
+    """In-memory кэш активных ПВЗ с R-деревом по координатам для поиска без обращения к БД.
+
+    Перечитывается из БД целиком: периодически (другие воркеры могли изменить ПВЗ)
+    и после коммита изменений ПВЗ в этом процессе.
+    """
+
+    def __init__(self):
+        # (rtree-индекс, {id: поля ПВЗ}) заменяются целиком, поэтому читаются без блокировки
+        self._snapshot = None
+        self._refresh_lock = threading.Lock()
+        self.stale = True
+
+    @property
+    def available(self) -> bool:
+        return rtree_index is not None
+
+    def refresh(self):
+        """Перечитывает активные ПВЗ из БД и перестраивает индекс"""
+        if not self.available:
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            return  # Индекс уже перестраивается; пока используем текущий снимок
+        try:
+            self.stale = False
+            with Session(engine) as db:
+                rows = db.execute(active_pvz_select({})).all()
+            pvz_by_id = {row.id: row._asdict() for row in rows}
+            index = rtree_index.Index()
+            for row in rows:
+                index.insert(row.id, (row.longitude, row.latitude, row.longitude, row.latitude))
+            self._snapshot = (index, pvz_by_id)
+        except Exception as e:
+            self.stale = True
+            logger.error(f"Ошибка обновления индекса ПВЗ: {e}")
+        finally:
+            self._refresh_lock.release()
+
+    def search(self, filters: dict, latitude: float, longitude: float, radius_km: float) -> Optional[list]:
+        """[(поля ПВЗ, distance_km)] в радиусе или None, если индекс еще не загружен"""
+        if self._snapshot is None:
+            return None
+        index, pvz_by_id = self._snapshot
+
+        # Отбор кандидатов по ограничивающему прямоугольнику, затем точный расчет расстояний
+        dlat = radius_km / 111.0
+        dlon = radius_km / (111.0 * max(math.cos(math.radians(latitude)), 0.01))
+        candidates = [
+            pvz_by_id[pvz_id]
+            for pvz_id in index.intersection((longitude - dlon, latitude - dlat, longitude + dlon, latitude + dlat))
+            if all(pvz_by_id[pvz_id][field] == value for field, value in filters.items())
+        ]
+        return nearest(candidates, latitude, longitude, radius_km)
+
+
+try:
+    from rtree import index as rtree_index
+except ImportError:
+    rtree_index = None
+    logger.warning("rtree не установлен: поиск ПВЗ по радиусу выполняется через БД")
+
+pvz_index = PVZIndex()
+
+
+@event.listens_for(PVZ, "after_insert")
+@event.listens_for(PVZ, "after_update")
+@event.listens_for(PVZ, "after_delete")
+def _mark_pvz_changed(mapper, connection, target):
+    object_session(target).info["pvz_changed"] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _mark_pvz_bulk_changed(orm_execute_state):
+    # INSERT/UPDATE/DELETE по PVZ через db.execute() не вызывают события маппера
+    if not orm_execute_state.is_select and orm_execute_state.bind_mapper is PVZ.__mapper__:
+        orm_execute_state.session.info["pvz_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_pvz_index(session):
+    if session.info.pop("pvz_changed", False):
+        pvz_index.stale = True
+
+
+async def pvz_index_refresh_loop():
+    """Периодическое обновление индекса ПВЗ (запускается в lifespan приложения)"""
+    while True:
+        await asyncio.to_thread(pvz_index.refresh)
+        await asyncio.sleep(settings.PVZ_INDEX_REFRESH_INTERVAL)
+
+
+def nearest(pvz_list: list, latitude: float, longitude: float, radius_km: float) -> list:
+    """[(pvz, distance_km)] для ПВЗ из pvz_list в радиусе, по возрастанию расстояния"""
+    lats = np.fromiter((pvz["latitude"] for pvz in pvz_list), dtype=COORD_DTYPE, count=len(pvz_list))
+    lons = np.fromiter((pvz["longitude"] for pvz in pvz_list), dtype=COORD_DTYPE, count=len(pvz_list))
+    idx, distances = within_radius(lats, lons, latitude, longitude, radius_km)
+    return [(pvz_list[i], float(d)) for i, d in zip(idx, distances)]
+
+
+def active_pvz_select(filters: dict) -> Select:
+    """Строки активных ПВЗ с колонками ответа"""
+    return select(*PVZ_RESPONSE_COLUMNS).where(PVZ.is_active == True).filter_by(**filters)
+
+
+async def find_pvz_within(db: AsyncSession, filters: dict, latitude: float, longitude: float, radius_km: float) -> list:
+    """Возвращает [(поля ПВЗ, distance_km)] для активных ПВЗ в радиусе, по возрастанию расстояния"""
+    if settings.USE_POSTGIS:
+        # ST_DWithin использует GiST-индекс, <-> сортирует по расстоянию через тот же индекс
+        point = func.geography(func.ST_SetSRID(func.ST_MakePoint(longitude, latitude), 4326))
+        result = await db.execute(
+            active_pvz_select(filters)
+            .add_columns(func.ST_Distance(PVZ_GEOG, point).label("distance_m"))
+            .where(func.ST_DWithin(PVZ_GEOG, point, radius_km * 1000))
+            .order_by(PVZ_GEOG.op("<->")(point))
+        )
+        return [(row._asdict(), row.distance_m / 1000) for row in result]
+
+    if pvz_index.available:
+        if pvz_index.stale:
+            # Перестроение индекса читает БД синхронно, поэтому выполняется вне event loop
+            await asyncio.to_thread(pvz_index.refresh)
+        found = pvz_index.search(filters, latitude, longitude, radius_km)
+        if found is not None:
+            return found
+
+    # Без PostGIS и индекса ПВЗ читаются из БД пачками, расстояния считаются векторно по каждой пачке:
+    # в памяти накапливаются только ПВЗ в радиусе, а не все активные ПВЗ
+    found = []
+    result = await db.stream(active_pvz_select(filters).execution_options(yield_per=PVZ_STREAM_BATCH_SIZE))
+    async for rows in result.partitions():
+        found.extend(nearest([row._asdict() for row in rows], latitude, longitude, radius_km))
+    found.sort(key=lambda item: item[1])
+    return found
+
+
+def with_distance(pvz: dict, distance: float) -> dict:
+    """Поля ответа ПВЗ с расстоянием до точки поиска"""
+    response = {field: pvz[field] for field in PVZResponse.model_fields}
+    response["distance_km"] = round(distance, 2)
+    return response
+
 
 @router.post("/", response_model=PVZResponse)
 async def create_pvz(
         pvz_data: PVZCreate,
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Создание нового ПВЗ"""
     try:
@@ -26,47 +188,37 @@ async def create_pvz(
                 detail="Только ПВЗ и администраторы могут создавать пункты выдачи"
             )
 
-        # Проверяем, что у пользователя еще нет ПВЗ
-        existing_pvz = db.query(PVZ).filter(PVZ.user_id == current_user.id).first()
-        if existing_pvz and current_user.role != "admin":
+        # Создаем ПВЗ (RETURNING вместо отдельного SELECT в db.refresh).
+        # Проверка, что у пользователя еще нет ПВЗ, выполняется в том же INSERT; админы не ограничены
+        values = {**pvz_data.model_dump(), "user_id": current_user.id, "is_active": True}
+        if current_user.role == "admin":
+            stmt = insert(PVZ).values(**values).returning(PVZ)
+        else:
+            await lock_owner(db, PVZ, current_user.id)
+            stmt = insert_unless_exists(PVZ, values, PVZ.user_id == current_user.id)
+        pvz = (await db.execute(stmt)).scalar_one_or_none()
+
+        if not pvz:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="У пользователя уже есть ПВЗ"
             )
 
-        # Создаем ПВЗ
-        pvz = PVZ(
-            user_id=current_user.id,
-            name=pvz_data.name,
-            address=pvz_data.address,
-            latitude=pvz_data.latitude,
-            longitude=pvz_data.longitude,
-            working_hours=pvz_data.working_hours,
-            operator_name=pvz_data.operator_name,
-            operator_phone=pvz_data.operator_phone,
-            accepts_tech=pvz_data.accepts_tech,
-            accepts_clothes=pvz_data.accepts_clothes,
-            accepts_shoes=pvz_data.accepts_shoes,
-            is_active=True
-        )
-
-        db.add(pvz)
-        db.commit()
-        db.refresh(pvz)
+        await db.commit()
 
         return pvz
 
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Ошибка при создании ПВЗ: {str(e)}"
         )
 
 
-@router.get("/", response_model=List[PVZResponse])
+@router.get("/", response_model=Page[PVZResponseWithDistance])
 async def get_pvz_list(
         latitude: Optional[float] = None,
         longitude: Optional[float] = None,
@@ -74,47 +226,50 @@ async def get_pvz_list(
         accepts_tech: Optional[bool] = None,
         accepts_clothes: Optional[bool] = None,
         accepts_shoes: Optional[bool] = None,
-        db: Session = Depends(get_db)
+        limit: int = Query(settings.PAGE_SIZE, ge=1, le=settings.MAX_PAGE_SIZE),
+        cursor: Optional[str] = None,
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Получение списка ПВЗ с возможностью фильтрации по местоположению"""
-    query = db.query(PVZ).filter(PVZ.is_active == True)
-
     # Фильтрация по типу принимаемых товаров
+    filters = {}
     if accepts_tech is not None:
-        query = query.filter(PVZ.accepts_tech == accepts_tech)
+        filters["accepts_tech"] = accepts_tech
     if accepts_clothes is not None:
-        query = query.filter(PVZ.accepts_clothes == accepts_clothes)
+        filters["accepts_clothes"] = accepts_clothes
     if accepts_shoes is not None:
-        query = query.filter(PVZ.accepts_shoes == accepts_shoes)
-
-    pvz_list = query.all()
+        filters["accepts_shoes"] = accepts_shoes
 
-    # Фильтрация по расстоянию, если указаны координаты
+    # Фильтрация по расстоянию, если указаны координаты: страницы идут по (расстояние, id).
+    # ПВЗ в радиусе уже отобраны целиком, поэтому страница вырезается из готового списка
     if latitude is not None and longitude is not None:
-        user_location = (latitude, longitude)
-        filtered_pvz = []
-
-        for pvz in pvz_list:
-            pvz_location = (pvz.latitude, pvz.longitude)
-            distance = geodesic(user_location, pvz_location).kilometers
-
-            if distance <= radius_km:
-                # Добавляем расстояние к объекту ПВЗ
-                pvz_dict = pvz.__dict__.copy()
-                pvz_dict['distance_km'] = round(distance, 2)
-                filtered_pvz.append(pvz_dict)
-
-        # Сортируем по расстоянию
-        filtered_pvz.sort(key=lambda x: x['distance_km'])
-        return filtered_pvz
+        found = await find_pvz_within(db, filters, latitude, longitude, radius_km)
+        found.sort(key=lambda item: (item[1], item[0]["id"]))
+        if cursor:
+            last_key = tuple(decode_cursor(cursor, 2))
+            found = [item for item in found if (item[1], item[0]["id"]) > last_key]
+        page = keyset_page(
+            found[:limit + 1], limit,
+            key=lambda item: (item[1], item[0]["id"]),
+            item=lambda item: with_distance(*item)
+        )
+    else:
+        stmt = active_pvz_select(filters)
+        if cursor:
+            last_id, = decode_cursor(cursor, 1)
+            stmt = stmt.where(PVZ.id > last_id)
+        rows = (await db.execute(stmt.order_by(PVZ.id).limit(limit + 1))).all()
+        page = keyset_page(rows, limit, key=lambda row: (row.id,))
 
-    return pvz_list
+    # Строки из типизированных колонок не проверяются повторно по response_model
+    # (он остается для документации): страница сразу сериализуется orjson
+    return ORJSONResponse(page)
 
 
 @router.get("/{pvz_id}", response_model=PVZResponse)
-async def get_pvz(pvz_id: int, db: Session = Depends(get_db)):
+async def get_pvz(pvz_id: int, db: AsyncSession = Depends(get_async_db)):
     """Получение ПВЗ по ID"""
-    pvz = db.query(PVZ).filter(PVZ.id == pvz_id).first()
+    pvz = await db.get(PVZ, pvz_id)
 
     if not pvz:
         raise HTTPException(
@@ -129,32 +284,31 @@ async def get_pvz(pvz_id: int, db: Session = Depends(get_db)):
 async def update_pvz(
         pvz_id: int,
         pvz_update: PVZCreate,
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Обновление ПВЗ"""
-    pvz = db.query(PVZ).filter(PVZ.id == pvz_id).first()
+    # Права на обновление проверяются в самом UPDATE, обновленная строка возвращается через RETURNING
+    stmt = update(PVZ).where(PVZ.id == pvz_id)
+    if current_user.role != "admin":
+        stmt = stmt.where(PVZ.user_id == current_user.id)
 
-    if not pvz:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="ПВЗ не найден"
-        )
+    update_data = pvz_update.model_dump(exclude_unset=True)
+    pvz = (await db.execute(stmt.values(**update_data).returning(PVZ))).scalar_one_or_none()
 
-    # Проверяем права на обновление
-    if current_user.role != "admin" and pvz.user_id != current_user.id:
+    if not pvz:
+        # Ничего не обновлено: ПВЗ нет или он чужой
+        if not await db.scalar(select(exists().where(PVZ.id == pvz_id))):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="ПВЗ не найден"
+            )
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Нет прав на обновление этого ПВЗ"
         )
 
-    # Обновляем поля
-    update_data = pvz_update.dict(exclude_unset=True)
-    for field, value in update_data.items():
-        setattr(pvz, field, value)
-
-    db.commit()
-    db.refresh(pvz)
+    await db.commit()
 
     return pvz
 
@@ -163,27 +317,30 @@ async def update_pvz(
 async def update_pvz_status(
         pvz_id: int,
         is_active: bool,
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Изменение статуса ПВЗ"""
-    pvz = db.query(PVZ).filter(PVZ.id == pvz_id).first()
+    # Права на изменение статуса проверяются в самом UPDATE
+    stmt = update(PVZ).where(PVZ.id == pvz_id)
+    if current_user.role != "admin":
+        stmt = stmt.where(PVZ.user_id == current_user.id)
 
-    if not pvz:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="ПВЗ не найден"
-        )
+    updated_id = (await db.execute(stmt.values(is_active=is_active).returning(PVZ.id))).scalar_one_or_none()
 
-    # Проверяем права на изменение статуса
-    if current_user.role != "admin" and pvz.user_id != current_user.id:
+    if updated_id is None:
+        # Ничего не обновлено: ПВЗ нет или он чужой
+        if not await db.scalar(select(exists().where(PVZ.id == pvz_id))):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="ПВЗ не найден"
+            )
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Нет прав на изменение статуса этого ПВЗ"
         )
 
-    pvz.is_active = is_active
-    db.commit()
+    await db.commit()
 
     return {"message": f"Статус ПВЗ изменен на {'активный' if is_active else 'неактивный'}"}
 
@@ -194,40 +351,28 @@ async def get_nearby_pvz(
         longitude: float,
         radius_km: float = 5,
         category: Optional[str] = None,
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Получение ближайших ПВЗ с поддержкой категорий"""
-    user_location = (latitude, longitude)
-
-    query = db.query(PVZ).filter(PVZ.is_active == True)
-
     # Фильтрация по категории
+    filters = {}
     if category:
         if category == "tech":
-            query = query.filter(PVZ.accepts_tech == True)
+            filters["accepts_tech"] = True
         elif category == "clothes":
-            query = query.filter(PVZ.accepts_clothes == True)
+            filters["accepts_clothes"] = True
         elif category == "shoes":
-            query = query.filter(PVZ.accepts_shoes == True)
-
-    pvz_list = query.all()
-    nearby_pvz = []
-
-    for pvz in pvz_list:
-        pvz_location = (pvz.latitude, pvz.longitude)
-        distance = geodesic(user_location, pvz_location).kilometers
-
-        if distance <= radius_km:
-            pvz_dict = pvz.__dict__.copy()
-            pvz_dict['distance_km'] = round(distance, 2)
-            nearby_pvz.append(pvz_dict)
+            filters["accepts_shoes"] = True
 
-    # Сортируем по расстоянию
-    nearby_pvz.sort(key=lambda x: x['distance_km'])
+    # Результат уже отсортирован по расстоянию
+    nearby_pvz = [
+        with_distance(pvz, distance)
+        for pvz, distance in await find_pvz_within(db, filters, latitude, longitude, radius_km)
+    ]
 
-    return {
+    return ORJSONResponse({
         "user_location": {"latitude": latitude, "longitude": longitude},
         "radius_km": radius_km,
         "pvz_count": len(nearby_pvz),
         "pvz_list": nearby_pvz
-    }
\ No newline at end of file
+    })
\ No newline at end of file
@@ -1,20 +1,31 @@
-from fastapi import APIRouter, HTTPException, Depends, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, HTTPException, Depends, Query, status
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import exists, func, insert, literal_column, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
 
-from database import get_db
-from models import Service, ServiceOffering, ServiceArea, User, VerificationStatus
-from schemas import ServiceCreate, ServiceResponse, ServiceOfferingCreate, ServiceOfferingResponse
-from auth import get_current_active_user
+from database import get_async_db, insert_unless_exists, lock_owner
+from models import Service, ServiceOffering, ServiceArea, VerificationStatus
+from schemas import Page, ServiceCreate, ServiceResponse, ServiceOfferingCreate, ServiceOfferingResponse
+from auth import get_current_active_user, invalidate_cached_user, CurrentUser
+from config import settings
+from pagination import decode_cursor, keyset_page
 
 router = APIRouter()
 
+# Колонки ответов: списки выбираются строками, без создания объектов модели
+SERVICE_RESPONSE_COLUMNS = tuple(getattr(Service, field) for field in ServiceResponse.model_fields)
+OFFERING_RESPONSE_COLUMNS = tuple(getattr(ServiceOffering, field) for field in ServiceOfferingResponse.model_fields)
+# Рейтинг для сортировки и курсора: average_rating может быть NULL, а сравнение с NULL
+# в условии курсора обрывало бы список. 0 - литерал, чтобы выражение совпадало с индексом
+SERVICE_RATING = func.coalesce(Service.average_rating, literal_column("0"))
+
 
 @router.post("/", response_model=ServiceResponse)
 async def create_service(
         service_data: ServiceCreate,
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Создание нового сервиса"""
     try:
@@ -25,74 +36,86 @@ async def create_service(
                 detail="Только сервисы и администраторы могут создавать сервисы"
             )
 
-        # Проверяем, что у пользователя еще нет сервиса
-        existing_service = db.query(Service).filter(Service.user_id == current_user.id).first()
-        if existing_service and current_user.role != "admin":
+        # Создаем сервис (RETURNING вместо отдельного SELECT в db.refresh).
+        # Проверка, что у пользователя еще нет сервиса, выполняется в том же INSERT
+        # (или не нужна вовсе, если id сервиса загружен при аутентификации); админы не ограничены
+        values = {
+            **service_data.model_dump(),
+            "user_id": current_user.id,
+            "verification_status": VerificationStatus.PENDING
+        }
+        service = None
+        if current_user.role == "admin":
+            service = (await db.execute(insert(Service).values(**values).returning(Service))).scalar_one()
+        elif current_user.service_id is None:
+            await lock_owner(db, Service, current_user.id)
+            service = (await db.execute(
+                insert_unless_exists(Service, values, Service.user_id == current_user.id)
+            )).scalar_one_or_none()
+
+        if not service:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="У пользователя уже есть сервис"
             )
 
-        # Создаем сервис
-        service = Service(
-            user_id=current_user.id,
-            company_name=service_data.company_name,
-            inn=service_data.inn,
-            activity_type=service_data.activity_type,
-            description=service_data.description,
-            phone=service_data.phone,
-            email=service_data.email,
-            bank_account=service_data.bank_account,
-            bank_bik=service_data.bank_bik,
-            verification_status=VerificationStatus.PENDING
-        )
-
-        db.add(service)
-        db.commit()
-        db.refresh(service)
+        await db.commit()
+        # В кэше пользователя service_id еще пустой: следующий запрос перечитает его из БД
+        await invalidate_cached_user(current_user.phone_number)
 
         return service
 
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Ошибка при создании сервиса: {str(e)}"
         )
 
 
-@router.get("/", response_model=List[ServiceResponse])
+@router.get("/", response_model=Page[ServiceResponse])
 async def get_services(
         activity_type: Optional[str] = None,
         verification_status: Optional[VerificationStatus] = None,
         min_rating: Optional[float] = None,
-        db: Session = Depends(get_db)
+        limit: int = Query(settings.PAGE_SIZE, ge=1, le=settings.MAX_PAGE_SIZE),
+        cursor: Optional[str] = None,
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Получение списка сервисов с фильтрацией"""
-    query = db.query(Service)
+    stmt = select(*SERVICE_RESPONSE_COLUMNS)
 
     # Фильтрация по типу деятельности
     if activity_type:
-        query = query.filter(Service.activity_type == activity_type)
+        stmt = stmt.where(Service.activity_type == activity_type)
 
     # Фильтрация по статусу верификации
     if verification_status:
-        query = query.filter(Service.verification_status == verification_status)
+        stmt = stmt.where(Service.verification_status == verification_status)
 
     # Фильтрация по минимальному рейтингу
     if min_rating is not None:
-        query = query.filter(Service.average_rating >= min_rating)
+        stmt = stmt.where(Service.average_rating >= min_rating)
+
+    # Keyset-пагинация по (рейтинг, id) через индекс ix_services_rating_id
+    if cursor:
+        last_rating, last_id = decode_cursor(cursor, 2)
+        stmt = stmt.where(tuple_(SERVICE_RATING, Service.id) < (last_rating, last_id))
 
-    services = query.order_by(Service.average_rating.desc()).all()
-    return services
+    result = await db.execute(stmt.order_by(SERVICE_RATING.desc(), Service.id.desc()).limit(limit + 1))
+    services = result.all()
+
+    # Строки из типизированных колонок не проверяются повторно по response_model
+    # (он остается для документации): страница сразу сериализуется orjson
+    return ORJSONResponse(keyset_page(services, limit, key=lambda row: (row.average_rating or 0, row.id)))
 
 
 @router.get("/{service_id}", response_model=ServiceResponse)
-async def get_service(service_id: int, db: Session = Depends(get_db)):
+async def get_service(service_id: int, db: AsyncSession = Depends(get_async_db)):
     """Получение сервиса по ID"""
-    service = db.query(Service).filter(Service.id == service_id).first()
+    service = await db.get(Service, service_id)
 
     if not service:
         raise HTTPException(
@@ -107,32 +130,31 @@ async def get_service(service_id: int, db: Session = Depends(get_db)):
 async def update_service(
         service_id: int,
         service_update: ServiceCreate,
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Обновление сервиса"""
-    service = db.query(Service).filter(Service.id == service_id).first()
+    # Права на обновление проверяются в самом UPDATE, обновленная строка возвращается через RETURNING
+    stmt = update(Service).where(Service.id == service_id)
+    if current_user.role != "admin":
+        stmt = stmt.where(Service.user_id == current_user.id)
 
-    if not service:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Сервис не найден"
-        )
+    update_data = service_update.model_dump(exclude_unset=True)
+    service = (await db.execute(stmt.values(**update_data).returning(Service))).scalar_one_or_none()
 
-    # Проверяем права на обновление
-    if current_user.role != "admin" and service.user_id != current_user.id:
+    if not service:
+        # Ничего не обновлено: сервиса нет или он чужой
+        if not await db.scalar(select(exists().where(Service.id == service_id))):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Сервис не найден"
+            )
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Нет прав на обновление этого сервиса"
         )
 
-    # Обновляем поля
-    update_data = service_update.dict(exclude_unset=True)
-    for field, value in update_data.items():
-        setattr(service, field, value)
-
-    db.commit()
-    db.refresh(service)
+    await db.commit()
 
     return service
 
@@ -141,8 +163,8 @@ async def update_service(
 async def update_service_verification(
         service_id: int,
         verification_status: VerificationStatus,
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Изменение статуса верификации сервиса (только для админов)"""
     if current_user.role != "admin":
@@ -151,16 +173,20 @@ async def update_service_verification(
             detail="Только администраторы могут изменять статус верификации"
         )
 
-    service = db.query(Service).filter(Service.id == service_id).first()
+    updated_id = await db.scalar(
+        update(Service)
+        .where(Service.id == service_id)
+        .values(verification_status=verification_status)
+        .returning(Service.id)
+    )
 
-    if not service:
+    if updated_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Сервис не найден"
         )
 
-    service.verification_status = verification_status
-    db.commit()
+    await db.commit()
 
     return {"message": f"Статус верификации изменен на {verification_status}"}
 
@@ -170,57 +196,55 @@ async def update_service_verification(
 async def create_service_offering(
         service_id: int,
         offering_data: ServiceOfferingCreate,
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Создание новой услуги для сервиса"""
-    service = db.query(Service).filter(Service.id == service_id).first()
+    # Владельцу сервиса не нужен отдельный запрос: его сервис известен из аутентификации
+    if current_user.service_id != service_id:
+        service = await db.get(Service, service_id)
 
-    if not service:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Сервис не найден"
-        )
-
-    # Проверяем права на создание услуги
-    if current_user.role != "admin" and service.user_id != current_user.id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Нет прав на создание услуг для этого сервиса"
-        )
+        if not service:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Сервис не найден"
+            )
 
-    offering = ServiceOffering(
-        service_id=service_id,
-        name=offering_data.name,
-        price=offering_data.price,
-        duration_days=offering_data.duration_days,
-        description=offering_data.description
-    )
+        # Проверяем права на создание услуги
+        if current_user.role != "admin" and service.user_id != current_user.id:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Нет прав на создание услуг для этого сервиса"
+            )
 
-    db.add(offering)
-    db.commit()
-    db.refresh(offering)
+    offering = (await db.execute(
+        insert(ServiceOffering)
+        .values(**offering_data.model_dump(), service_id=service_id)
+        .returning(ServiceOffering)
+    )).scalar_one()
+    await db.commit()
 
     return offering
 
 
 @router.get("/{service_id}/offerings", response_model=List[ServiceOfferingResponse])
-async def get_service_offerings(service_id: int, db: Session = Depends(get_db)):
+async def get_service_offerings(service_id: int, db: AsyncSession = Depends(get_async_db)):
     """Получение списка услуг сервиса"""
-    service = db.query(Service).filter(Service.id == service_id).first()
+    service_exists = await db.scalar(select(exists().where(Service.id == service_id)))
 
-    if not service:
+    if not service_exists:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Сервис не найден"
         )
 
-    offerings = db.query(ServiceOffering).filter(
+    result = await db.execute(select(*OFFERING_RESPONSE_COLUMNS).where(
         ServiceOffering.service_id == service_id,
         ServiceOffering.is_active == True
-    ).all()
+    ))
+    offerings = result.all()
 
-    return offerings
+    return ORJSONResponse([row._asdict() for row in offerings])
 
 
 @router.put("/{service_id}/offerings/{offering_id}", response_model=ServiceOfferingResponse)
@@ -228,14 +252,27 @@ async def update_service_offering(
         service_id: int,
         offering_id: int,
         offering_update: ServiceOfferingCreate,
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Обновление услуги сервиса"""
-    offering = db.query(ServiceOffering).filter(
-        ServiceOffering.id == offering_id,
-        ServiceOffering.service_id == service_id
-    ).first()
+    # Проверяем права на обновление
+    if current_user.service_id != service_id and current_user.role != "admin":
+        owner_id = await db.scalar(select(Service.user_id).where(Service.id == service_id))
+        if owner_id != current_user.id:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Нет прав на обновление этой услуги"
+            )
+
+    # Обновляем поля, обновленная строка возвращается через RETURNING
+    update_data = offering_update.model_dump(exclude_unset=True)
+    offering = (await db.execute(
+        update(ServiceOffering)
+        .where(ServiceOffering.id == offering_id, ServiceOffering.service_id == service_id)
+        .values(**update_data)
+        .returning(ServiceOffering)
+    )).scalar_one_or_none()
 
     if not offering:
         raise HTTPException(
@@ -243,21 +280,7 @@ async def update_service_offering(
             detail="Услуга не найдена"
         )
 
-    # Проверяем права на обновление
-    service = db.query(Service).filter(Service.id == service_id).first()
-    if current_user.role != "admin" and service.user_id != current_user.id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Нет прав на обновление этой услуги"
-        )
-
-    # Обновляем поля
-    update_data = offering_update.dict(exclude_unset=True)
-    for field, value in update_data.items():
-        setattr(offering, field, value)
-
-    db.commit()
-    db.refresh(offering)
+    await db.commit()
 
     return offering
 
@@ -266,14 +289,14 @@ async def update_service_offering(
 async def delete_service_offering(
         service_id: int,
         offering_id: int,
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Удаление услуги сервиса (деактивация)"""
-    offering = db.query(ServiceOffering).filter(
+    offering = await db.scalar(select(ServiceOffering).where(
         ServiceOffering.id == offering_id,
         ServiceOffering.service_id == service_id
-    ).first()
+    ))
 
     if not offering:
         raise HTTPException(
@@ -282,14 +305,15 @@ async def delete_service_offering(
         )
 
     # Проверяем права на удаление
-    service = db.query(Service).filter(Service.id == service_id).first()
-    if current_user.role != "admin" and service.user_id != current_user.id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Нет прав на удаление этой услуги"
-        )
+    if current_user.service_id != service_id:
+        service = await db.get(Service, service_id)
+        if current_user.role != "admin" and service.user_id != current_user.id:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Нет прав на удаление этой услуги"
+            )
 
     offering.is_active = False
-    db.commit()
+    await db.commit()
 
     return {"message": "Услуга деактивирована"}
\ No newline at end of file
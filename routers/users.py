@@ -1,17 +1,24 @@
-from fastapi import APIRouter, HTTPException, Depends, status
-from sqlalchemy.orm import Session
-from typing import List, Optional
+from fastapi import APIRouter, HTTPException, Depends, Query, status
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional
 
-from database import get_db
+from database import get_async_db
 from models import User, UserRole
-from schemas import UserUpdate, UserResponse
-from auth import get_current_active_user
+from schemas import Page, UserUpdate, UserResponse
+from auth import get_current_active_user, invalidate_cached_user, CurrentUser
+from config import settings
+from pagination import decode_cursor, keyset_page
 
 router = APIRouter()
 
+# Колонки ответа: список пользователей выбирается строками, без создания объектов модели
+USER_RESPONSE_COLUMNS = tuple(getattr(User, field) for field in UserResponse.model_fields)
+
 
 @router.get("/me", response_model=UserResponse)
-async def get_current_user(current_user: User = Depends(get_current_active_user)):
+async def get_current_user(current_user: CurrentUser = Depends(get_current_active_user)):
     """Получение информации о текущем пользователе"""
     return current_user
 
@@ -19,34 +26,43 @@ async def get_current_user(current_user: User = Depends(get_current_active_user)
 @router.put("/me", response_model=UserResponse)
 async def update_current_user(
         user_update: UserUpdate,
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Обновление информации о текущем пользователе"""
     try:
-        # Обновляем только разрешенные поля
-        update_data = user_update.dict(exclude_unset=True)
-        for field, value in update_data.items():
-            setattr(current_user, field, value)
-
-        db.commit()
-        db.refresh(current_user)
+        # Обновляем только разрешенные поля, которые есть в таблице (колонки name у пользователя нет),
+        # одним UPDATE ... RETURNING
+        update_data = {
+            field: value
+            for field, value in user_update.model_dump(exclude_unset=True).items()
+            if field in User.__table__.c
+        }
+        if not update_data:
+            return await db.get(User, current_user.id)
+
+        user = await db.scalar(
+            update(User).where(User.id == current_user.id).values(**update_data).returning(User)
+        )
+        await db.commit()
 
-        return current_user
+        return user
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Ошибка при обновлении профиля: {str(e)}"
         )
 
 
-@router.get("/", response_model=List[UserResponse])
+@router.get("/", response_model=Page[UserResponse])
 async def get_users(
         role: Optional[UserRole] = None,
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        limit: int = Query(settings.PAGE_SIZE, ge=1, le=settings.MAX_PAGE_SIZE),
+        cursor: Optional[str] = None,
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Получение списка пользователей (только для админов)"""
     if current_user.role != "admin":
@@ -55,22 +71,30 @@ async def get_users(
             detail="Только администраторы могут просматривать список пользователей"
         )
 
-    query = db.query(User)
+    stmt = select(*USER_RESPONSE_COLUMNS)
     if role:
-        query = query.filter(User.role == role)
+        stmt = stmt.where(User.role == role)
 
-    users = query.filter(User.is_active == True).all()
-    return users
+    # Keyset-пагинация по id
+    if cursor:
+        last_id, = decode_cursor(cursor, 1)
+        stmt = stmt.where(User.id > last_id)
+
+    result = await db.execute(stmt.where(User.is_active == True).order_by(User.id).limit(limit + 1))
+    users = result.all()
+
+    # Строки из типизированных колонок не проверяются повторно по response_model
+    return ORJSONResponse(keyset_page(users, limit, key=lambda row: (row.id,)))
 
 
 @router.get("/{user_id}", response_model=UserResponse)
 async def get_user(
         user_id: int,
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Получение пользователя по ID"""
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
 
     if not user:
         raise HTTPException(
@@ -92,8 +116,8 @@ async def get_user(
 async def update_user_status(
         user_id: int,
         is_active: bool,
-        current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)
+        current_user: CurrentUser = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Изменение статуса пользователя (только для админов)"""
     if current_user.role != "admin":
@@ -102,15 +126,18 @@ async def update_user_status(
             detail="Только администраторы могут изменять статус пользователей"
         )
 
-    user = db.query(User).filter(User.id == user_id).first()
+    # Телефон нужен только для сброса кэша пользователя, поэтому возвращается из того же UPDATE
+    phone_number = await db.scalar(
+        update(User).where(User.id == user_id).values(is_active=is_active).returning(User.phone_number)
+    )
 
-    if not user:
+    if phone_number is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Пользователь не найден"
         )
 
-    user.is_active = is_active
-    db.commit()
+    await db.commit()
+    await invalidate_cached_user(phone_number)
 
     return {"message": f"Статус пользователя изменен на {'активный' if is_active else 'неактивный'}"}
\ No newline at end of file
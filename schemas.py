@@ -1,8 +1,22 @@
 from pydantic import BaseModel, EmailStr, validator
-from typing import Optional, List
+from typing import Generic, Optional, List, TypeVar
 from datetime import datetime
+import re
+import orjson
 from models import UserRole, OrderStatus, OrderCategory, PaymentMethod, VerificationStatus
 
+# Все символы кроме цифр (компилируется один раз при импорте)
+NON_DIGITS_RE = re.compile(r'\D')
+
+
+T = TypeVar("T")
+
+
+# Страница списка с keyset-пагинацией
+class Page(BaseModel, Generic[T]):
+    items: List[T]
+    next_cursor: Optional[str] = None  # None - последняя страница
+
 
 # Базовые схемы
 class UserBase(BaseModel):
@@ -38,9 +52,8 @@ class PhoneAuth(BaseModel):
     @validator('phone_number')
     def validate_phone(cls, v):
         # Улучшенная валидация российского номера
-        import re
         # Удаляем все символы кроме цифр
-        cleaned = re.sub(r'\D', '', v)
+        cleaned = NON_DIGITS_RE.sub('', v)
 
         # Проверяем различные форматы российских номеров
         if len(cleaned) == 11 and cleaned.startswith('7'):
@@ -56,6 +69,12 @@ class SMSCode(BaseModel):
     code: str
 
 
+class SendSmsResponse(BaseModel):
+    message: str
+    phone_number: str
+    code: Optional[str] = None  # Только в режиме разработки
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -141,6 +160,10 @@ class PVZResponse(PVZBase):
         from_attributes = True
 
 
+class PVZResponseWithDistance(PVZResponse):
+    distance_km: Optional[float] = None  # Заполняется при поиске по координатам
+
+
 # Схемы для заказов
 class OrderBase(BaseModel):
     category: OrderCategory
@@ -196,11 +219,10 @@ class OrderWithPhotos(OrderResponse):
 
     @validator('photos', pre=True)
     def parse_photos(cls, v):
-        if isinstance(v, str):
-            import json
+        if isinstance(v, (str, bytes)):
             try:
-                return json.loads(v)
-            except:
+                return orjson.loads(v)
+            except orjson.JSONDecodeError:
                 return []
         return v or []
 